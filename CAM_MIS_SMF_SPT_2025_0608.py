@@ -1,62 +1,15 @@
 # 改善されたメモリダンプ表示コード
 import MT25QL01GBBB_20231023 as MT25QL01GBBB
+from MT25QL01GBBB_regions import region_table
 
-Flash = MT25QL01GBBB.flash()
+Flash = MT25QL01GBBB.get_flash()
 
 keydata = input("input dump start address or shortcut key\n")
 
-# アドレス設定
-CORN_MSN_TMBHEAD_DATA_ADDRESS = 0x05B60000
-CORN_MSN_TMB_DATA_ADDRESS = 0x05B61000
-AURORA_MSN_TMBHEAD_DATA_ADDRESS = 0x06340000
-AURORA_MSN_TMB_DATA_ADDRESS = 0x6341000
-PUMICE_MSN_TMBHEAD_DATA_ADDRESS = 0x06699000
-PUMICE_MSN_TMB_DATA_ADDRESS = 0x0669A000
-
-CORN_MSN_HEAD_DATA_ADDRESS = 0x069F2000
-CORN_MSN_DATA_ADDRESS = 0x069F3000
-AURORA_MSN_HEAD_DATA_ADDRESS = 0x06D13000
-AURORA_MSN_DATA_ADDRESS = 0x06D14000
-PUMICE_MSN_HEAD_DATA_ADDRESS = 0x07034000
-PUMICE_MSN_DATA_ADDRESS = 0x07035000
-
-CHIBANY_PHOTO_COPY_SIZE = 0x00000000
-CHIBANY_PHOTO_COPY = 0x00001000
-CHIBANY_PHOTO_COPY_2 = 0x3000
-
-# アドレス決定
-if keydata == 'a':
-    readAddress = CORN_MSN_TMBHEAD_DATA_ADDRESS
-elif keydata == 'b':
-    readAddress = CORN_MSN_TMB_DATA_ADDRESS
-elif keydata == 'k':
-    readAddress = AURORA_MSN_TMBHEAD_DATA_ADDRESS
-elif keydata == 'l':
-    readAddress = AURORA_MSN_TMB_DATA_ADDRESS
-elif keydata == 'm':
-    readAddress = PUMICE_MSN_TMBHEAD_DATA_ADDRESS
-elif keydata == 'n':
-    readAddress = PUMICE_MSN_TMB_DATA_ADDRESS
-elif keydata == 'e':
-    readAddress = CORN_MSN_HEAD_DATA_ADDRESS
-elif keydata == 'f':
-    readAddress = CORN_MSN_DATA_ADDRESS
-elif keydata == 's':
-    readAddress = AURORA_MSN_HEAD_DATA_ADDRESS
-elif keydata == 't':
-    readAddress = AURORA_MSN_DATA_ADDRESS
-elif keydata == 'x':
-    readAddress = PUMICE_MSN_HEAD_DATA_ADDRESS
-elif keydata == 'y':
-    readAddress = PUMICE_MSN_DATA_ADDRESS
-elif keydata == '0':
-    readAddress = CHIBANY_PHOTO_COPY_SIZE
-elif keydata == '1':
-    readAddress = CHIBANY_PHOTO_COPY
-elif keydata == '2':
-    readAddress = CHIBANY_PHOTO_COPY_2
-else:
-    readAddress = int(keydata, 16)
+# アドレス決定 (フラッシュ上の領域表から名前・ショートカットキーで引く)
+Regions = region_table(Flash)
+Regions.load_or_default()
+readAddress = Regions.resolve(keydata)
 
 # データ読み込み
 data = Flash.READ_DATA_BYTES2_SMF(readAddress, 4096)
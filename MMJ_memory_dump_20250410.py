@@ -1,6 +1,7 @@
 import MT25QL01GBBB_20231023 as MT25QL01GBBB
+from MT25QL01GBBB_regions import region_table
 
-Flash = MT25QL01GBBB.flash()
+Flash = MT25QL01GBBB.get_flash()
 
 # 1. アドレスの入力
 keydata = input("input dump start address or shortcut key\n")
@@ -22,67 +23,21 @@ except ValueError:
         print(f"Invalid length. Using default {DEFAULT_DUMP_SIZE} bytes.")
         readLength = DEFAULT_DUMP_SIZE
 
-# --- アドレス設定 ---
-CORN_MSN_TMBHEAD_DATA_ADDRESS = 0x05B60000
-CORN_MSN_TMB_DATA_ADDRESS = 0x05B61000
-AURORA_MSN_TMBHEAD_DATA_ADDRESS = 0x06340000
-AURORA_MSN_TMB_DATA_ADDRESS = 0x6341000
-PUMICE_MSN_TMBHEAD_DATA_ADDRESS = 0x06699000
-PUMICE_MSN_TMB_DATA_ADDRESS = 0x0669A000
-
-CORN_MSN_HEAD_DATA_ADDRESS = 0x069F2000
-CORN_MSN_DATA_ADDRESS = 0x069F3000
-AURORA_MSN_HEAD_DATA_ADDRESS = 0x06D13000
-AURORA_MSN_DATA_ADDRESS = 0x06D14000
-PUMICE_MSN_HEAD_DATA_ADDRESS = 0x07034000
-PUMICE_MSN_DATA_ADDRESS = 0x07035000
-
-CHIBANY_PHOTO_COPY_SIZE = 0x00000000
-CHIBANY_PHOTO_COPY = 0x00001000
-
 # --- アドレス決定 ---
-if keydata == 'a':
-    readAddress = CORN_MSN_TMBHEAD_DATA_ADDRESS
-elif keydata == 'b':
-    readAddress = CORN_MSN_TMB_DATA_ADDRESS
-elif keydata == 'k':
-    readAddress = AURORA_MSN_TMBHEAD_DATA_ADDRESS
-elif keydata == 'l':
-    readAddress = AURORA_MSN_TMB_DATA_ADDRESS
-elif keydata == 'm':
-    readAddress = PUMICE_MSN_TMBHEAD_DATA_ADDRESS
-elif keydata == 'n':
-    readAddress = PUMICE_MSN_TMB_DATA_ADDRESS
-elif keydata == 'e':
-    readAddress = CORN_MSN_HEAD_DATA_ADDRESS
-elif keydata == 'f':
-    readAddress = CORN_MSN_DATA_ADDRESS
-elif keydata == 's':
-    readAddress = AURORA_MSN_HEAD_DATA_ADDRESS
-elif keydata == 't':
-    readAddress = AURORA_MSN_DATA_ADDRESS
-elif keydata == 'x':
-    readAddress = PUMICE_MSN_HEAD_DATA_ADDRESS
-elif keydata == 'y':
-    readAddress = PUMICE_MSN_DATA_ADDRESS
-elif keydata == '0':
-    readAddress = CHIBANY_PHOTO_COPY_SIZE
-elif keydata == '1':
-    readAddress = CHIBANY_PHOTO_COPY
-else:
-    try:
-        readAddress = int(keydata , 16)
-    except ValueError:
-        print("Invalid address. Exiting.")
-        exit()
+# アドレス定数とショートカットキーはフラッシュ上の領域表から引く
+# (表がなければ MT25QL01GBBB_regions.DEFAULT_REGIONS を使う)
+Regions = region_table(Flash)
+Regions.load_or_default()
+try:
+    readAddress = Regions.resolve(keydata)
+except ValueError:
+    print("Invalid address. Exiting.")
+    exit()
 
 # 4. データ読み込み (readLength を使用)
+# 長いダンプでも一定メモリで済むよう、4096バイトずつ流し読みしながら表示する
+DUMP_CHUNK_SIZE = 4096  # 16の倍数にすること
 print(f"Reading {readLength} bytes from {hex(readAddress)}...")
-try:
-    data = Flash.READ_DATA_BYTES2_SMF(readAddress, readLength)
-except Exception as e:
-    print(f"Error reading flash memory: {e}")
-    exit() # エラーが発生したら終了
 
 # --- ヘッダーの表示 (オフセット表示を改善) ---
 print(f"Dumping {readLength} bytes starting from address: {hex(readAddress)}")
@@ -93,36 +48,44 @@ print(" | ASCII Characters |")
 print("-" * 68) # 区切り線
 
 # 5. データの表示 (readLength に基づいてループ)
-num_rows = (readLength + 15) // 16 # 表示に必要な行数を計算 (切り上げ)
-
-for j in range(num_rows):
-    offset = j * 16
-    print(f"{offset:04X}:", end=" ") # オフセットを4桁16進数で表示
-
-    # 16進数データの表示
-    hex_str = ""
-    for i in range(16):
-        current_index = offset + i
-        if current_index < readLength:
-            # データを f-string の :02X で2桁16進数に
-            hex_str += f"{data[current_index]:02X} "
-        else:
-            hex_str += "   " # データの範囲外は空白
-    print(hex_str, end="")
-
-    # ASCII文字の表示
-    ascii_str = ""
-    for i in range(16):
-        current_index = offset + i
-        if current_index < readLength:
-            byte = data[current_index]
-            if 32 <= byte <= 126:
-                ascii_str += chr(byte)
-            else:
-                ascii_str += "."
-        else:
-            ascii_str += " " # データの範囲外は空白
-
-    print(f" | {ascii_str}")
+chunk_offset = 0
+try:
+    for data in Flash.read_chunks(readAddress, readLength, DUMP_CHUNK_SIZE):
+        chunkLength = len(data)
+        num_rows = (chunkLength + 15) // 16 # 表示に必要な行数を計算 (切り上げ)
+
+        for j in range(num_rows):
+            offset = j * 16
+            print(f"{chunk_offset + offset:04X}:", end=" ") # オフセットを4桁16進数で表示
+
+            # 16進数データの表示
+            hex_str = ""
+            for i in range(16):
+                current_index = offset + i
+                if current_index < chunkLength:
+                    # データを f-string の :02X で2桁16進数に
+                    hex_str += f"{data[current_index]:02X} "
+                else:
+                    hex_str += "   " # データの範囲外は空白
+            print(hex_str, end="")
+
+            # ASCII文字の表示
+            ascii_str = ""
+            for i in range(16):
+                current_index = offset + i
+                if current_index < chunkLength:
+                    byte = data[current_index]
+                    if 32 <= byte <= 126:
+                        ascii_str += chr(byte)
+                    else:
+                        ascii_str += "."
+                else:
+                    ascii_str += " " # データの範囲外は空白
+
+            print(f" | {ascii_str}")
+        chunk_offset += chunkLength
+except Exception as e:
+    print(f"Error reading flash memory: {e}")
+    exit() # エラーが発生したら終了
 
 print("\nDump completed.")
@@ -3,6 +3,29 @@
 # This code is for testing(Writing and Reading data) Micron's SPI Flash memory, on the BIRDS OBC board.
 # Changelog
 # 2021/11/10 多バイト読み込み用関数[READ_DATA_BYTES_SMF]と多バイト書き込み用関数[WRITE_DATA_BYTES_SMF]
+# 2026/10 bytes/memoryviewベースの転送(read_into, read_bytes, write_page)。ヘッダは共有バッファに詰めてioctlで直接転送
+# 2026/10 spidevのbufsizを超える読み込みを分割(read_into)、一定メモリで流し読みするread_chunks
+# 2026/10 ページ境界で分割して任意長を書き込むwrite_bytes
+# 2026/10 固定sleepをやめ、データシートの時間と実測から決めるwait_readyでビジー待ち
+# 2026/10 4KB/32KB/64KB/ダイ消去を組み合わせるerase_range(plan_erase, estimate_erase_time)
+# 2026/10 消去済み確認is_blankと、必要なときだけ消去・書き込みするupdate_bytes
+# 2026/10 MT25Q_EMULATOR でエミュレータ(MT25QL01GBBB_emulator.py)に切り替え
+# 2026/10 FAST READ(0x0C)/2線(0x3C)/4線(0x6C)読み込み(set_read_mode)、コマンドごとのクロック(set_command_speed)
+# 2026/10 LRU読み込みキャッシュ(enable_cache, cache_stats)。書き込み・消去で該当ブロックを捨てる
+# 2026/10 ページごとのcrc32で照合するverify_range、書き込み後に照合するverify_writes
+# 2026/10 消去の一時停止/再開(suspend, resume)と、消去中でも割り込んで読むread_urgent_into
+# 2026/10 ロックファイルによるプロセス間のバス調停(MT25QL01GBBB_arbiter.py, bus_stats)
+# 2026/10 SPIクロックの自動調整(calibrate_clock)。結果を保存して次回から baud の既定値にする
+# 2026/10 コマンドごとの回数・バイト数・時間ヒストグラムとビジー待ち時間の計測(enable_instrumentation)
+# 2026/10 性能測定スクリプト(MT25QL01GBBB_benchmark.py)。wait_ready はステータスを読む前の時刻でタイムアウトを判定
+# 2026/10 close()/with で閉じる(__del__ が self.spi を閉じようとしていたのを修正)。プロセス内で共有する get_flash と、まとめて実行するための lock
+# 2026/10 64KBセクタごとの消去回数を数えてファイルに保存(erase_counts, wear_stats)
+# 2026/10 2つのバッファで読み込みと書き込みを重ねる領域コピー(copy_range)。コピー先は書き込む直前に消去
+# 2026/10 4KBごとの書き込み・消去の記録(changed)と、全体の占有マップ(MT25QL01GBBB_scan.py)
+# 2026/10 read_into も self._lock の中で読む(共有ヘッダの取り合いと、別スレッドの書き込み・消去中の読み込みを防ぐ)
+# 2026/10 消去回数は保存のたびにロックを取ってファイルの値に足し込む(複数プロセスで数え漏れない)
+# 2026/10 書き込み・消去の開始は、別のスレッドの書き込み・消去が終わるまで待つ(_wait_idle)
+# 2026/10 消去回数・書き込みの記録・クロック調整の結果はホームではなく STATE_DIR (sudo でも同じ所)に 0666 で置く
 
 
 
@@ -13,17 +36,242 @@ import os
 import collections
 import random
 import binascii
-import RPi.GPIO as GPIO
+import ctypes
+import fcntl
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # Raspberry Pi 以外(エミュレータで動かすとき)
+    GPIO = None
 from time import sleep
 import datetime
-import spidev
+import json
+try:
+    import spidev
+except ImportError:
+    spidev = None
 import time
+import threading
+import queue
+import contextlib
+import atexit
 from array import array
 
 from decimal import Decimal, ROUND_HALF_UP, ROUND_HALF_EVEN
 
 
 
+# spidev の ioctl (linux/spi/spidev.h) を直接叩くための定義
+# struct spi_ioc_transfer: tx_buf, rx_buf, len, speed_hz, delay_usecs,
+#                          bits_per_word, cs_change, tx_nbits, rx_nbits, word_delay_usecs, pad
+SPI_IOC_MAGIC = ord('k')
+SPI_IOC_TRANSFER = struct.Struct('<QQIIHBBBBBB')
+
+
+SPI_IOC_RD_MODE32 = 0x80046b05  # _IOR(SPI_IOC_MAGIC, 5, __u32)
+SPI_IOC_WR_MODE32 = 0x40046b05  # _IOW(SPI_IOC_MAGIC, 5, __u32)
+SPI_RX_DUAL = 0x400
+SPI_RX_QUAD = 0x800
+
+
+def SPI_IOC_MESSAGE(n):
+    # _IOW(SPI_IOC_MAGIC, 0, char[SPI_MSGSIZE(n)])
+    return 0x40000000 | ((SPI_IOC_TRANSFER.size * n) << 16) | (SPI_IOC_MAGIC << 8)
+
+
+# spidevの1メッセージあたりの上限(カーネルのbufsizパラメータ)。既定は4096
+SPIDEV_BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+
+
+def spidev_bufsiz(default=4096):
+    try:
+        with open(SPIDEV_BUFSIZ_PATH) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return default
+
+
+# バッファの先頭アドレスを取得する(コピーしない)
+def buffer_address(buf):
+    if isinstance(buf, bytes):
+        return ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+
+# 環境変数 MT25Q_EMULATOR にイメージファイルのパスを入れると、実機の代わりに
+# MT25QL01GBBB_emulator のエミュレータを使う
+EMULATOR_ENV = 'MT25Q_EMULATOR'
+
+
+def open_spidev():
+    if os.environ.get(EMULATOR_ENV):
+        import MT25QL01GBBB_emulator
+        return MT25QL01GBBB_emulator.SpiDev(os.environ[EMULATOR_ENV])
+    return spidev.SpiDev()
+
+
+# コマンド・ビジー待ちごとの計測 (flash.enable_instrumentation で有効にする)
+# 時間はヒストグラムで持つ: i 番目のビンは [2^(i-1), 2^i) us (0番目は 1us 未満)
+HISTOGRAM_BINS = 32
+OPCODE_NAMES = {
+    0x9F: 'READ_ID', 0x05: 'READ_STATUS', 0x70: 'READ_FLAG_STATUS', 0x06: 'WRITE_ENABLE',
+    0x13: 'READ', 0x0C: 'FAST_READ', 0x3C: 'DUAL_OUTPUT_FAST_READ', 0x6C: 'QUAD_OUTPUT_FAST_READ',
+    0x12: 'PAGE_PROGRAM', 0x21: 'ERASE_4KB', 0x5C: 'ERASE_32KB', 0xDC: 'ERASE_64KB', 0xC4: 'DIE_ERASE',
+    0x75: 'SUSPEND', 0x7A: 'RESUME',
+}
+
+
+class flash_stats:
+    FIELDS = ('kind', 'name', 'count', 'bytes', 'total_s', 'mean_s', 'max_s', 'histogram_us')
+
+    def __init__(self):
+        self.commands = {}  # オペコード → [回数, バイト数, 合計時間, 最大時間, ヒストグラム]
+        self.busy = {}      # wait_ready の動作名 → [回数, 0, 合計時間, 最大時間, ヒストグラム]
+
+    @staticmethod
+    def _add(table, key, nbytes, seconds):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = [0, 0, 0.0, 0.0, [0] * HISTOGRAM_BINS]
+        entry[0] += 1
+        entry[1] += nbytes
+        entry[2] += seconds
+        if seconds > entry[3]:
+            entry[3] = seconds
+        entry[4][min(int(seconds * 1e6).bit_length(), HISTOGRAM_BINS - 1)] += 1
+
+    def record(self, opcode, nbytes, seconds):
+        self._add(self.commands, opcode, nbytes, seconds)
+
+    def record_busy(self, op, seconds):
+        self._add(self.busy, op, 0, seconds)
+
+    def rows(self):
+        for kind, table in (('command', self.commands), ('busy', self.busy)):
+            for key in sorted(table, key=str):
+                count, nbytes, total, longest, hist = table[key]
+                name = OPCODE_NAMES.get(key, '0x{:02X}'.format(key)) if kind == 'command' else key
+                yield (kind, name, count, nbytes, total, total / count, longest, hist)
+
+    def to_dict(self):
+        return [dict(zip(self.FIELDS, row)) for row in self.rows()]
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    # ヒストグラムは ; 区切りで1列に入れる
+    def dump_csv(self, path):
+        with open(path, 'w') as f:
+            f.write(','.join(self.FIELDS) + '\n')
+            for row in self.rows():
+                f.write(','.join(str(v) for v in row[:-1]) + ',' + ';'.join(str(n) for n in row[-1]) + '\n')
+
+
+# 消去回数・書き込みの記録・クロック調整の結果を置くディレクトリ
+# sudo で動かしても(HOME=/root になっても)同じファイルを使うよう、ホームではなく共有の場所に置き、
+# ディレクトリは 0777、ファイルは 0666 にする (/var/tmp は再起動で消えない。MT25Q_STATE_DIR で変えられる)
+STATE_DIR = os.environ.get('MT25Q_STATE_DIR', '/var/tmp/MT25QL01GBBB')
+# calibrate_clock で求めたSPIクロックの保存先。flash(baud=None) のときはここの値を使う
+CALIBRATION_PATH = os.path.join(STATE_DIR, 'spi_clock.json')
+DEFAULT_BAUD = 1000000
+
+
+def load_calibrated_baud(path=CALIBRATION_PATH, default=DEFAULT_BAUD):
+    try:
+        with open(path) as f:
+            return int(json.load(f)['safe_hz'])
+    except (OSError, ValueError, KeyError):
+        return default
+
+
+# 64KBセクタごとの消去回数の保存先 (セクタ数 × 4バイトの配列)
+# エミュレータのときはイメージファイルの隣に置く (spi にエミュレータを渡したときはそのイメージ)
+def default_erase_count_path(bus, CSB, spi=None):
+    image = getattr(spi, 'image', None) or os.environ.get(EMULATOR_ENV)
+    if image:
+        return image + '.erase_counts'
+    return os.path.join(STATE_DIR, 'erase_counts_{}.{}'.format(bus, CSB))
+
+
+# ディレクトリがなければ作り、どのユーザーも書けるようにする
+def make_shared_dir(path):
+    if path and not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+        try:
+            os.chmod(path, 0o777)
+        except OSError:
+            # 他のユーザーが先に作っていた
+            pass
+
+
+# data を別名で書いてから置き換える(書きかけで壊れないように)
+# sudo で書いても他のユーザーが置き換えられるよう 0666 にする
+def write_shared_file(path, data):
+    make_shared_dir(os.path.dirname(path))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        try:
+            os.fchmod(f.fileno(), 0o666)
+        except OSError:
+            pass
+    os.replace(tmp, path)
+
+
+# 保存した回数の配列(消去回数など)を読む。ないか大きさが合わなければすべて0
+def load_counts(path, size):
+    counts = array('I', bytes(4 * size))
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return counts
+    if len(raw) == len(counts) * counts.itemsize:
+        counts = array('I')
+        counts.frombytes(raw)
+    return counts
+
+
+# path + '.lock' の排他ロック(flock)を取る with 用
+# 同じ記録ファイルを使う他のプロセスと、読み直し→足し合わせ→書き込みが重ならないようにする
+# (sudo で作られても他のユーザーが開けるよう、バス調停のロックファイルと同じく 0666 で作る)
+@contextlib.contextmanager
+def counts_file_lock(path):
+    import MT25QL01GBBB_arbiter
+    make_shared_dir(os.path.dirname(path))
+    fd = MT25QL01GBBB_arbiter.open_lock_file(path + '.lock')
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+# 転送結果(バイト数, 所要時間[s], スループット[B/s])
+transfer_stats = collections.namedtuple('transfer_stats', ['nbytes', 'seconds', 'bytes_per_sec'])
+# update_bytes の結果(消去したサブセクタ数, 書き込んだページ数, 書き込みを省いたページ数)
+update_stats = collections.namedtuple('update_stats', ['erased_subsectors', 'programmed_pages', 'skipped_pages'])
+
+
+# verify_range で見つかった不一致ページ(アドレス, 期待するcrc32, 読み出したcrc32)
+page_mismatch = collections.namedtuple('page_mismatch', ['address', 'expected_crc', 'actual_crc'])
+
+
+# data をページ(page_size バイト)ごとに区切った crc32 の配列を返す
+# (verify_range に渡せば、元のデータがなくても照合できる)
+def page_crcs(data, page_size=256):
+    view = memoryview(data).cast('B')
+    return array('I', (binascii.crc32(view[i:i + page_size]) for i in range(0, len(view), page_size)))
+
+
+# new の各ビットが old の 1→0 の変化だけで作れるか(消去なしで書けるか)
+# バイトごとではなく、バッファ全体を整数にして一度に比較する
+def only_clears_bits(old, new):
+    n = int.from_bytes(new, 'little')
+    return int.from_bytes(old, 'little') & n == n
+
+
 class flash:
     #Vref = 3.3
     #ADRANGE = 4096
@@ -36,126 +284,553 @@ class flash:
     # define READ_ID              0x9F
     READ_STATUS_REG = 0x05
     READ_DATA_BYTES = 0x13  # 0x03 for byte
+    FAST_READ = 0x0C  # 4byte, ダミー8クロック
+    DUAL_OUTPUT_FAST_READ = 0x3C  # 4byte, ダミー8クロック, データは2線
+    QUAD_OUTPUT_FAST_READ = 0x6C  # 4byte, ダミー8クロック, データは4線
     ENABLE_WRITE = 0x06
     WRITE_PAGE = 0x12  # 0x02 for 3byte
     ERASE_SECTOR = 0xDC  # 0xD8 for 3byte
     ERASE_4KB_SUBSECTOR = 0x21
     ERASE_32KB_SUBSECTOR = 0x5C
     DIE_ERASE = 0xC4
+    PROGRAM_ERASE_SUSPEND = 0x75
+    PROGRAM_ERASE_RESUME = 0x7A
+    READ_FLAG_STATUS_REG = 0x70
     
     SUBSECTOR_SIZE_OF_4KB = 4096
     SUBSECTOR_SIZE_OF_32KB = 0x8000
     SECTOR_SIZE = 0x10000
+    DIE_SIZE = 0x4000000  # 512Mbit x 2 die
+    FLASH_SIZE = 0x8000000
     DATA_BUFFER_SIZE = 256
 
-    def __init__(self, bus=0, CSB=0, baud=1000000):
-        self.h = spidev.SpiDev()
+    # 読み込みモード: (オペコード, ダミーバイト数, データ線数, 最大クロック[Hz])
+    READ_MODES = {
+        'read': (READ_DATA_BYTES, 0, 1, 66000000),
+        'fast': (FAST_READ, 1, 1, 133000000),
+        'dual': (DUAL_OUTPUT_FAST_READ, 1, 2, 133000000),
+        'quad': (QUAD_OUTPUT_FAST_READ, 1, 4, 133000000),
+    }
+    MAX_DUMMY_BYTES = 1
+
+    # calibrate_clock で試すSPIクロック[Hz] (Raspberry Piのコアクロックを割って出せる付近の値)
+    CLOCK_STEPS = (1000000, 2000000, 4000000, 8000000, 10000000, 15600000, 20000000,
+                   25000000, 31200000, 41600000, 50000000, 62500000)
+    # パターン確認に使う4KB (領域表 0x07FFF000 のすぐ手前)
+    CALIBRATION_SCRATCH = 0x07FFE000
+
+    # 消去単位(小さい順): (サイズ, wait_readyの動作名)
+    ERASE_UNITS = (
+        (SUBSECTOR_SIZE_OF_4KB, 'erase_4kb'),
+        (SUBSECTOR_SIZE_OF_32KB, 'erase_32kb'),
+        (SECTOR_SIZE, 'erase_64kb'),
+        (DIE_SIZE, 'die_erase'),
+    )
+
+    # 各動作の完了時間 [s] (データシートの typ, max)
+    BUSY_TIMES = {
+        'program': (0.00012, 0.0018),
+        'erase_4kb': (0.05, 0.4),
+        'erase_32kb': (0.1, 1.0),
+        'erase_64kb': (0.15, 1.0),
+        'die_erase': (153.0, 460.0),
+    }
+    BUSY_TIMEOUT_MARGIN = 2.0   # max の何倍でタイムアウトにするか
+    BUSY_ADAPT_RATE = 0.25      # 実測値で推定時間を更新する割合
+    BUSY_POLL_DIVISION = 50     # 推定時間の何分の1間隔でポーリングするか
+    MIN_SLEEP = 0.0002          # これより短い待ちはsleepせずに回す
+
+    # 一時停止(SUSPEND)できる動作。ダイ消去はデータシート上 一時停止できない
+    SUSPENDABLE_OPS = ('erase_4kb', 'erase_32kb', 'erase_64kb')
+    SUSPEND_TIMEOUT = 0.001         # 一時停止を待つ時間 (データシートのmaxは数十us)
+    SUSPEND_MIN_INTERVAL = 0.0005   # 再開してから次に一時停止するまでの最短時間(消去を進めるため)
+
+    # 消去回数を何回分ためたらファイルに保存するか
+    ERASE_COUNT_SAVE_EVERY = 16
+
+    # spi: spidev.SpiDev 互換のオブジェクト(エミュレータなど)を直接渡すときに使う
+    # arbitrate: 他のプロセスとバスを取り合わないよう、コマンドのまとまりごとにロックファイルを取る
+    # baud=None なら calibrate_clock で保存したクロック(なければ1MHz)
+    # erase_count_path: 消去回数の保存先 (None なら default_erase_count_path)
+    #   同じファイルを使うプロセスが複数あっても、保存のたびにファイルの値へ自分の分を足すので数え漏れない
+    def __init__(self, bus=0, CSB=0, baud=None, spi=None, arbitrate=True, erase_count_path=None):
+        self.h = spi if spi is not None else open_spidev()
         self.h.open(bus, CSB)
-        # 1MHz
+        if baud is None:
+            baud = load_calibrated_baud()
         self.h.max_speed_hz = baud
         self.h.mode = 0
 
+        if arbitrate:
+            import MT25QL01GBBB_arbiter
+            self.arbiter = MT25QL01GBBB_arbiter.get_arbiter(MT25QL01GBBB_arbiter.lock_path(bus, CSB))
+            self._bus = self.arbiter
+        else:
+            self.arbiter = None
+            self._bus = contextlib.nullcontext()
+
+        # コマンド(1byte)+アドレス(4byte)のヘッダは毎回作らずに使い回す
+        self._header = bytearray(5 + self.MAX_DUMMY_BYTES)
+        self._ioc = bytearray(SPI_IOC_TRANSFER.size * 2)
+        # 1回の転送で読めるデータ量(ヘッダ分を引く)
+        self.max_transfer = spidev_bufsiz() - len(self._header)
+        # コマンドごとのSPIクロック[Hz] (0 や未登録なら max_speed_hz)
+        self.command_hz = {}
+        self.read_mode = 'read'
+        self._read_cmd, self._read_dummy, self._read_nbits, _ = self.READ_MODES['read']
+        # True にすると write_bytes / update_bytes のあとに読み戻して照合する
+        self.verify_writes = False
+        # 読み込みキャッシュ(enable_cache で有効にする)
+        self._cache = None
+        self.cache_block = self.SUBSECTOR_SIZE_OF_4KB
+        self.cache_budget = 0
+        self.cache_hits = self.cache_misses = self.cache_evictions = 0
+        # 複数のコマンドをまとめて(他のスレッドに割り込まれずに)実行するときに取るロック
+        # write_bytes / update_bytes / erase_range はこの中で動く
+        self.lock = threading.RLock()
+        self.closed = False
+        # 計測 (enable_instrumentation で有効にする。無効なら何もしない)
+        self.instrument = None
+        # 書き込み・消去の開始、ビジー確認、一時停止はこのロックの中で行う
+        self._lock = threading.RLock()
+        # 書き込み・消去が終わったことを知らせる (チップは1つずつしか受け付けないので、次の開始はこれを待つ)
+        self._idle = threading.Condition(self._lock)
+        self._busy_op = None        # 実行中の書き込み/消去 (wait_ready の動作名)
+        self._busy_range = None     # その範囲 (開始, 終了)
+        self._paused_total = 0.0    # 一時停止していた時間の合計[s]
+        self._last_resume = 0.0
+        self._suspend_start = 0.0
+        # 64KBセクタごとの消去回数 (4KB/32KBの消去もそのセクタの1回に数える)
+        self.erase_count_path = erase_count_path or default_erase_count_path(bus, CSB, spi)
+        self.erase_counts = load_counts(self.erase_count_path, self.FLASH_SIZE // self.SECTOR_SIZE)
+        # まだ保存していない、このプロセスで数えた分
+        self._erase_deltas = array('I', bytes(len(self.erase_counts) * 4))
+        self._unsaved_erases = 0
+        # 4KBサブセクタごとに、最後に書き込み・消去したときの通し番号(change_counter)
+        # (MT25QL01GBBB_scan.py の占有マップが、前のスキャンから変わった所だけ調べ直すのに使う)
+        # 消去回数と一緒にファイルに保存し、通し番号は前回の続きから数える
+        # (保存するときに、他のプロセスの記録とぶつからない番号に付け替える。save_erase_counts)
+        self.change_path = self.erase_count_path + '.changes'
+        self.changed = load_counts(self.change_path, self.FLASH_SIZE // self.SUBSECTOR_SIZE_OF_4KB)
+        self.change_counter = self._saved_change_counter = max(self.changed)
+        # 動作ごとの完了時間の推定値(実測で更新していく)
+        self.busy_estimate = {op: t[0] for op, t in self.BUSY_TIMES.items()}
+        # 本物のspidevならioctlで直接転送する(リストを経由しない)
+        try:
+            self._fd = self.h.fileno()
+        except (AttributeError, OSError):
+            self._fd = None
+
+    # spidev を閉じる(2回目以降は何もしない)
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self._unsaved_erases or self.change_counter != self._saved_change_counter:
+                self.save_erase_counts()
+            self.h.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
     def __del__(self):
         try:
-            self.spi.close()
-        except:
+            self.close()
+        except Exception:
             pass
 
 
+    # ヘッダ(コマンド+4バイトアドレス+ダミー)を共有バッファに詰める
+    def _pack_header(self, cmd, address, dummy=0):
+        struct.pack_into('>BI', self._header, 0, cmd, address & 0xffffffff)
+        return memoryview(self._header)[:5 + dummy]
+
+    # ヘッダを送ったあと、CSを上げずに tx を送信 / rx に受信する
+    # tx, rx はどちらも bytes-like (rx は書き込み可能なもの)
+    # クロックは command_hz のコマンドごとの設定、rx_nbits は受信のデータ線数
+    def _transfer(self, header, tx=None, rx=None, rx_nbits=0):
+        length = len(tx) if tx is not None else (len(rx) if rx is not None else 0)
+        speed_hz = self.command_hz.get(header[0], 0)
+        if self._fd is not None:
+            SPI_IOC_TRANSFER.pack_into(self._ioc, 0, buffer_address(header), 0,
+                                       len(header), speed_hz, 0, 0, 0, 0, 0, 0, 0)
+            if length:
+                SPI_IOC_TRANSFER.pack_into(self._ioc, SPI_IOC_TRANSFER.size,
+                                           buffer_address(tx) if tx is not None else 0,
+                                           buffer_address(rx) if rx is not None else 0,
+                                           length, speed_hz, 0, 0, 0, 0, rx_nbits, 0, 0)
+                fcntl.ioctl(self._fd, SPI_IOC_MESSAGE(2), self._ioc)
+            else:
+                fcntl.ioctl(self._fd, SPI_IOC_MESSAGE(1), self._ioc)
+            return
+        # ioctlが使えない場合(spidev互換オブジェクトなど)はxfer2で送る
+        if rx is not None:
+            rcvdata = self.h.xfer2(bytes(header) + bytes(length), speed_hz)
+            rx[0:length] = bytes(rcvdata[len(header):])
+        elif speed_hz:
+            self.h.xfer2(bytes(header) + bytes(tx or b''), speed_hz)
+        elif tx is not None:
+            self.h.writebytes2(bytes(header) + bytes(tx))
+        else:
+            self.h.writebytes2(bytes(header))
+
+    # 短いコマンド(ステータス読み出しなど)を送る
+    def _xfer(self, packet):
+        return self.h.xfer2(packet)
+
+    # コマンドごとの回数・バイト数・所要時間と、ビジー待ちの時間を記録する
+    # 有効にしている間だけ、計測つきの _transfer / _xfer に差し替える
+    def enable_instrumentation(self):
+        self.instrument = flash_stats()
+        stats = self.instrument
+        transfer = flash._transfer.__get__(self)
+        xfer = flash._xfer.__get__(self)
+        clock = time.perf_counter
+
+        def timed_transfer(header, tx=None, rx=None, rx_nbits=0):
+            t0 = clock()
+            transfer(header, tx, rx, rx_nbits)
+            n = len(tx) if tx is not None else (len(rx) if rx is not None else 0)
+            stats.record(header[0], len(header) + n, clock() - t0)
+
+        def timed_xfer(packet):
+            t0 = clock()
+            rcvdata = xfer(packet)
+            stats.record(packet[0], len(packet), clock() - t0)
+            return rcvdata
+
+        self._transfer = timed_transfer
+        self._xfer = timed_xfer
+        return stats
+
+    def disable_instrumentation(self):
+        self.__dict__.pop('_transfer', None)
+        self.__dict__.pop('_xfer', None)
+        stats = self.instrument
+        self.instrument = None
+        return stats
+
+    # spidevの受信線数を設定する(nbits=2/4 なら SPI_RX_DUAL/QUAD、1 なら両方を外す)。できなければ False
+    # 対応していないコントローラでも spi_setup が警告だけでビットを落として成功するので、読み戻して確かめる
+    def _set_rx_nbits(self, nbits):
+        if self._fd is None:
+            return nbits <= 1
+        flag = {2: SPI_RX_DUAL, 4: SPI_RX_QUAD}.get(nbits, 0)
+        buf = bytearray(4)
+        try:
+            fcntl.ioctl(self._fd, SPI_IOC_RD_MODE32, buf)
+            mode = int.from_bytes(buf, 'little') & ~(SPI_RX_DUAL | SPI_RX_QUAD) | flag
+            fcntl.ioctl(self._fd, SPI_IOC_WR_MODE32, mode.to_bytes(4, 'little'))
+            fcntl.ioctl(self._fd, SPI_IOC_RD_MODE32, buf)
+        except OSError:
+            return False
+        return int.from_bytes(buf, 'little') & flag == flag
+
+    # 読み込みコマンドを選ぶ: 'read'(0x13), 'fast'(0x0C), 'dual'(0x3C), 'quad'(0x6C)
+    # speed_hz を指定するとそのコマンドのクロックにする(データシートの最大値まで)
+    # 2線/4線がSPIコントローラで使えない場合は 'read' に戻す。戻り値は選ばれたモード
+    def set_read_mode(self, mode, speed_hz=None):
+        cmd, dummy, nbits, max_hz = self.READ_MODES[mode]
+        if not self._set_rx_nbits(nbits):
+            mode = 'read'
+            cmd, dummy, nbits, max_hz = self.READ_MODES[mode]
+            self._set_rx_nbits(nbits)
+        if speed_hz is not None:
+            self.set_command_speed(cmd, min(speed_hz, max_hz))
+        self.read_mode = mode
+        self._read_cmd, self._read_dummy, self._read_nbits = cmd, dummy, nbits
+        return mode
+
+    # コマンド(オペコード)ごとのSPIクロックを設定する。0 で max_speed_hz に戻す
+    def set_command_speed(self, cmd, speed_hz):
+        if speed_hz:
+            self.command_hz[cmd] = int(speed_hz)
+        else:
+            self.command_hz.pop(cmd, None)
+
+    # 指定アドレスから buf の長さ分を読み込み、buf に直接書き込む
+    # buf: bytearray / memoryview など書き込み可能なバッファ
+    # spidevの上限を超える長さは max_transfer ごとに分割して読む
+    # キャッシュが有効なら、キャッシュにあるブロックはSPIを使わずに返す
+    # 別のスレッドが書き込み・消去中なら read_urgent_into と同じく、一時停止するか終わるのを待ってから読む
+    def read_into(self, address, buf):
+        view = memoryview(buf).cast('B')
+        with self._bus:
+            with self._lock:
+                if self._busy_op is None:
+                    return self._read_ready(address, view)
+            return self.read_urgent_into(address, view)
+
+    # 書き込み・消去中でないときの読み込み (self._lock の中で呼ぶ)
+    def _read_ready(self, address, view):
+        if self._cache is not None and len(view) <= self.cache_budget:
+            return self._read_cached(address, view)
+        return self._read_uncached(address, view)
+
+    def _read_uncached(self, address, view):
+        step = self.max_transfer
+        for offset in range(0, len(view), step):
+            self._transfer(self._pack_header(self._read_cmd, address + offset, self._read_dummy),
+                           rx=view[offset:offset + step],
+                           rx_nbits=self._read_nbits if self._read_nbits > 1 else 0)
+        return len(view)
+
+    # バス調停の統計(待たされた回数・時間など)。調停なしなら None
+    def bus_stats(self):
+        return self.arbiter.stats() if self.arbiter is not None else None
+
+    # 読み込みキャッシュを有効にする
+    # block_size ごとに揃えたブロック単位で持ち、合計 budget バイトを超えたら古いものから捨てる(LRU)
+    # 書き込み・消去したブロックは捨てる。budget より大きい読み込みはキャッシュを通さない
+    def enable_cache(self, budget=1024 * 1024, block_size=SUBSECTOR_SIZE_OF_4KB):
+        self._cache = collections.OrderedDict()
+        self.cache_budget = budget
+        self.cache_block = block_size
+        self.cache_hits = self.cache_misses = self.cache_evictions = 0
+
+    def disable_cache(self):
+        self._cache = None
+        self.cache_budget = 0
+
+    # キャッシュの統計(ヒット/ミス/追い出し回数と使用バイト数)
+    def cache_stats(self):
+        cached = len(self._cache) * self.cache_block if self._cache is not None else 0
+        total = self.cache_hits + self.cache_misses
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+            'hit_rate': self.cache_hits / total if total else 0.0,
+            'bytes': cached,
+            'budget': self.cache_budget,
+        }
+
+    def _read_cached(self, address, view):
+        cache = self._cache
+        block = self.cache_block
+        offset = 0
+        while offset < len(view):
+            a = address + offset
+            base = a - a % block
+            n = min(base + block, address + len(view)) - a
+            data = cache.get(base)
+            if data is None:
+                self.cache_misses += 1
+                data = bytearray(block)
+                self._read_uncached(base, memoryview(data))
+                cache[base] = data
+                while len(cache) * block > self.cache_budget:
+                    cache.popitem(last=False)
+                    self.cache_evictions += 1
+            else:
+                self.cache_hits += 1
+                cache.move_to_end(base)
+            view[offset:offset + n] = data[a - base:a - base + n]
+            offset += n
+        return len(view)
+
+    # address から length バイトにかかるキャッシュを捨てる(書き込み・消去のとき)
+    def _invalidate(self, address, length):
+        cache = self._cache
+        if not cache:
+            return
+        block = self.cache_block
+        start = address - address % block
+        end = address + length
+        if (end - start) // block > len(cache):
+            for base in [b for b in cache if start <= b < end]:
+                del cache[base]
+        else:
+            for base in range(start, end, block):
+                cache.pop(base, None)
+
+    def _mark_changed(self, address, length):
+        self.change_counter += 1
+        unit = self.SUBSECTOR_SIZE_OF_4KB
+        for i in range(address // unit, -(-(address + length) // unit)):
+            self.changed[i] = self.change_counter
+
+    # address から length バイトを chunk_size ごとに順に返すジェネレータ
+    # 返すmemoryviewは使い回しのバッファなので、次の要素を取るまでに使い切ること
+    # (メモリ使用量は length によらず chunk_size 分だけ)
+    def read_chunks(self, address, length, chunk_size=None, buf=None):
+        if buf is None:
+            buf = bytearray(chunk_size or self.max_transfer)
+        view = memoryview(buf).cast('B')
+        chunk_size = len(view)
+        end = address + length
+        while address < end:
+            n = min(chunk_size, end - address)
+            self.read_into(address, view[:n])
+            yield view[:n]
+            address += n
+
+    # 指定アドレスから amount バイト読み込んで bytearray で返す
+    def read_bytes(self, address, amount):
+        buf = bytearray(amount)
+        self.read_into(address, buf)
+        return buf
+
+    # 1ページ内(最大256バイト)に data を書き込む。data は bytes-like
+    def write_page(self, address, data):
+        if not isinstance(data, (bytes, bytearray)):
+            data = memoryview(data).cast('B')
+            if data.readonly:
+                data = data.tobytes()
+        with self._bus:
+            with self._lock:
+                self._wait_idle()
+                self.WRITE_ENABLE_OF()
+                self._transfer(self._pack_header(self.WRITE_PAGE, address), tx=data)
+                self._busy_op = 'program'
+                self._busy_range = (address, address + len(data))
+                self._mark_changed(address, len(data))
+                self._invalidate(address, len(data))
+            self.wait_ready('program')
+
+    # 任意長の data を 256バイトのページ境界で分割して書き込む
+    # (書き込み先は消去済みであること) 戻り値は transfer_stats
+    def write_bytes(self, address, data):
+        with self.lock:
+            view = memoryview(data).cast('B')
+            total = len(view)
+            start = time.monotonic()
+            offset = 0
+            while offset < total:
+                page_left = self.DATA_BUFFER_SIZE - (address + offset) % self.DATA_BUFFER_SIZE
+                n = min(page_left, total - offset)
+                self.write_page(address + offset, view[offset:offset + n])
+                offset += n
+            if self.verify_writes:
+                self._check_written(address, view)
+            elapsed = time.monotonic() - start
+            return transfer_stats(total, elapsed, total / elapsed if elapsed > 0 else 0.0)
+
+    # address から length バイトがすべて 0xFF (消去済み) か調べる
+    def is_blank(self, address, length):
+        blank = b'\xff' * min(length, self.SUBSECTOR_SIZE_OF_4KB)
+        for chunk in self.read_chunks(address, length, len(blank)):
+            if chunk != blank[:len(chunk)]:
+                return False
+        return True
+
+    # old (現在の内容) と new を比べ、違うページだけ書き込む
+    # 戻り値は (書き込んだページ数, 省いたページ数)
+    def _program_changed(self, address, old, new):
+        programmed = skipped = 0
+        offset = 0
+        while offset < len(new):
+            n = min(self.DATA_BUFFER_SIZE - (address + offset) % self.DATA_BUFFER_SIZE, len(new) - offset)
+            if old[offset:offset + n] == new[offset:offset + n]:
+                skipped += 1
+            else:
+                self.write_page(address + offset, new[offset:offset + n])
+                programmed += 1
+            offset += n
+        return programmed, skipped
+
+    # data を address に書き込む。消去・書き込みは必要な分だけ行う
+    #  - すでに同じ内容ならなにもしない
+    #  - 1→0 の変化だけなら消去せずに書き込む(消去済みの領域もこれに当たる)
+    #  - それ以外はサブセクタ(4KB)を読み出して合成し、消去してから書き戻す
+    # 戻り値は update_stats
+    def update_bytes(self, address, data):
+        with self.lock:
+            view = memoryview(data).cast('B')
+            unit = self.SUBSECTOR_SIZE_OF_4KB
+            current = memoryview(bytearray(unit))
+            erased = programmed = skipped = 0
+            offset = 0
+            end = address + len(view)
+            while offset < len(view):
+                a = address + offset
+                base = a - a % unit
+                n = min(base + unit, end) - a
+                new = view[offset:offset + n]
+                old = current[:n]
+                self.read_into(a, old)
+                if old == new:
+                    skipped += (n + self.DATA_BUFFER_SIZE - 1) // self.DATA_BUFFER_SIZE
+                elif only_clears_bits(old, new):
+                    p, k = self._program_changed(a, old, new)
+                    programmed += p
+                    skipped += k
+                else:
+                    self.read_into(base, current)
+                    merged = bytearray(current)
+                    merged[a - base:a - base + n] = new
+                    self.SUBSECTOR_4KB_ERASE_OF(base)
+                    erased += 1
+                    p, k = self._program_changed(base, b'\xff' * unit, merged)
+                    programmed += p
+                    skipped += k
+                offset += n
+            if self.verify_writes:
+                self._check_written(address, view)
+            return update_stats(erased, programmed, skipped)
+
+    # address からの内容を expected と照合し、一致しないページを page_mismatch のリストで返す
+    # expected は書いたはずのデータ(bytes-like)か、page_crcs で作ったページごとのcrc32の配列
+    # (ページは address から page_size バイトごとの区切り)
+    # chunk_size ずつ読み、データ同士ならチャンクごとにまとめて比べて、違うチャンクだけページに分けて調べる
+    def verify_range(self, address, expected, length=None, chunk_size=0x10000, page_size=DATA_BUFFER_SIZE):
+        if isinstance(expected, array):
+            crcs = expected
+            data = None
+            if length is None:
+                raise ValueError('length is required when verifying against crcs')
+        else:
+            crcs = None
+            data = memoryview(expected).cast('B')
+            if length is None:
+                length = len(data)
+        # ページの途中で区切らないよう、chunk_size はページの倍数にする(ページより小さければ1ページ)
+        chunk_size = max(chunk_size - chunk_size % page_size, page_size)
+        mismatches = []
+        offset = 0
+        for chunk in self.read_chunks(address, length, chunk_size):
+            n = len(chunk)
+            if data is not None and chunk == data[offset:offset + n]:
+                offset += n
+                continue
+            for p in range(0, n, page_size):
+                actual = binascii.crc32(chunk[p:p + page_size])
+                if data is not None:
+                    want = binascii.crc32(data[offset + p:offset + p + page_size])
+                else:
+                    want = crcs[(offset + p) // page_size]
+                if actual != want:
+                    mismatches.append(page_mismatch(address + offset + p, want, actual))
+            offset += n
+        return mismatches
+
+    # 書き込み直後の照合。違っていれば IOError
+    def _check_written(self, address, view):
+        mismatches = self.verify_range(address, view)
+        if mismatches:
+            raise IOError('verify failed at {} page(s): {}'.format(
+                len(mismatches), ', '.join('0x{:08x}'.format(m.address) for m in mismatches[:8])))
+
+    # アドレスだけを伴うコマンド(消去など)を送る
+    def _command_address(self, cmd, address):
+        self._transfer(self._pack_header(cmd, address))
+
+
     # SMFから1バイト読み込む
     def READ_DATA_BYTE_SMF(self, sector_address):
-        #print("-------- read SMF START --------")
-        cmd = [0x13]
-        packet = cmd
-        # 読み込みアドレスを格納
-        data = (sector_address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & sector_address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-        # 読み込むバイト数を定義
-        packet = packet + [0x00]
-        # 生成したパケットをもとにSMFからデータを読み込む
-        rcvdata = self.h.xfer2(packet)
-
-        #print("-------- read SMF complete --------")
-        return rcvdata[5]
+        return self.read_bytes(sector_address, 1)[0]
 
     # SMFから多バイト読み込む
+    # 戻り値は bytearray (リストと同じく添字やlist()で使える)
     def READ_DATA_BYTES_SMF(self, sector_address, amount):
-        #print("-------- read SMF START --------")
-        cmd = [0x13]
-        packet = cmd
-        # 読み込みアドレスを格納
-        data = (sector_address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & sector_address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-        # 読み込むバイト数を定義
-        #for i in range(int(amount)):
-        
-        packet = packet + [0x00] * amount
-        # 生成したパケットをもとにSMFからデータを読み込む
-        rcvdata = self.h.xfer2(packet)
-
-        #print("-------- read SMF complete --------")
-        #return rcvdata[amount]
-        return rcvdata[5:]
+        return self.read_bytes(sector_address, amount)
 
     def READ_DATA_BYTES2_SMF(self, sector_address, amount):
-        #print("-------- read SMF START --------")
-        cmd = [0x13]
-        packet = cmd
-        # 読み込みアドレスを格納
-        data = (sector_address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & sector_address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-        # 読み込むバイト数を定義
-        #for i in range(int(amount)):
-        
-        packet = packet + [0x00] * amount
-        # 生成したパケットをもとにSMFからデータを読み込む
-        rcvdata = self.h.xfer3(packet)
-
-        #print("-------- read SMF complete --------")
-        #return rcvdata[amount]
-        return rcvdata[5:]
+        return self.read_bytes(sector_address, amount)
 
 
 
@@ -167,134 +842,354 @@ class flash:
     # veryfication confirmed on 22th Sep.
 
     def read_chip_id(self):
-        #cmd = [0x9F,0x00]
-        cmd = [0x9F, 0] + [255 for _ in range(19)]
-        chip_id = self.h.xfer2(cmd)[1:]
+        chip_id = self._read_id()
         time.sleep(0.01)
         print('0x{:x}'.format(chip_id[0]))
         print('0x{:x}'.format(chip_id[1]))
         print("CHIP ID >>>", '0x{:x}'.format(chip_id[0]))
         return chip_id
 
+    # チップIDを読む(表示なし)
+    def _read_id(self):
+        #cmd = [0x9F,0x00]
+        cmd = [0x9F, 0] + [255 for _ in range(19)]
+        with self._bus:
+            return self._xfer(cmd)[1:]
+
+    # SPIクロックを段階的に上げ、チップIDとパターンの読み戻しが正しい最高のクロックを探す
+    # scratch の4KBは消去して試験パターンを書く(中身は失われる)
+    # 見つかった最高値に margin を掛けた値を使う。save=True なら CALIBRATION_PATH に保存
+    # 戻り値は {'max_ok_hz', 'safe_hz', 'results': [(クロック, 成否), ...]}
+    def calibrate_clock(self, scratch=CALIBRATION_SCRATCH, steps=CLOCK_STEPS, repeats=8,
+                        margin=0.8, save=True, path=CALIBRATION_PATH):
+        base_hz = steps[0]
+        self.h.max_speed_hz = base_hz
+        expected_id = bytes(self._read_id()[:3])
+        # 0x00/0xFF/0x55/0xAA の並びと連番、疑似乱数を混ぜてビットの変化を多くする
+        pattern = bytearray(b'\x00\xff\x55\xaa' * 256)
+        pattern[1024:2048] = bytes(range(256)) * 4
+        pattern[2048:] = random.Random(0x25ab).getrandbits(8 * 2048).to_bytes(2048, 'little')
+        self.update_bytes(scratch, pattern)
+        if self.read_bytes(scratch, len(pattern)) != pattern:
+            raise IOError('calibration pattern could not be written at {} Hz'.format(base_hz))
+        results = []
+        max_ok = base_hz
+        buf = bytearray(len(pattern))
+        for hz in steps:
+            self.h.max_speed_hz = hz
+            ok = True
+            for _ in range(repeats):
+                if bytes(self._read_id()[:3]) != expected_id:
+                    ok = False
+                    break
+                with self._lock:
+                    self._read_uncached(scratch, memoryview(buf))
+                if buf != pattern:
+                    ok = False
+                    break
+            results.append((hz, ok))
+            if not ok:
+                break
+            max_ok = hz
+        safe = int(max_ok * margin)
+        self.h.max_speed_hz = safe
+        result = {'max_ok_hz': max_ok, 'safe_hz': safe, 'results': results}
+        if save:
+            write_shared_file(path, json.dumps(dict(result, date=datetime.datetime.now().isoformat()), indent=1).encode())
+        return result
+
     # veryfication confirmed on 22th Sep.
 
     # Funcion que borra un sector de 4KB de la Main Flash
     def SUBSECTOR_4KB_ERASE_OF(self, sector_address):
         # Recibe la direccion del sector que se quiere borrar
-
-        cmd = [self.ERASE_4KB_SUBSECTOR]
-
-        packet = cmd
-        # 読み込みアドレスを格納
-        data = (sector_address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & sector_address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        packet = packet
-
-        self.WRITE_ENABLE_OF()  # Funcion que habilita escritura en Own Flash
-
-        # ///////////////////////////////////////////////////////////////////
-        rcvdata = self.h.xfer2(packet)
-        # //////////////////////////////////////////////////////////////////
-        time.sleep(0.02)
-        while self.read_status_register() & 0x01 == 1:
-            time.sleep(0.01)
-            print("erase")
-            
+        with self._bus:
+            # ///////////////////////////////////////////////////////////////////
+            self._start_erase(self.ERASE_4KB_SUBSECTOR, 'erase_4kb', sector_address, self.SUBSECTOR_SIZE_OF_4KB)
+            # //////////////////////////////////////////////////////////////////
+            self.wait_ready('erase_4kb')
         return
 
     def SUBSECTOR_32KB_ERASE_OF(self, sector_address):
         # Recibe la direccion del sector que se quiere borrar
-
-        cmd = [self.ERASE_32KB_SUBSECTOR]
-
-        packet = cmd
-        # 読み込みアドレスを格納
-        data = (sector_address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & sector_address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        packet = packet
-
-        self.WRITE_ENABLE_OF()  # Funcion que habilita escritura en Own Flash
-
-        # ///////////////////////////////////////////////////////////////////
-        rcvdata = self.h.xfer2(packet)
-        # //////////////////////////////////////////////////////////////////
-        time.sleep(0.01)
-        while self.read_status_register() & 0x01 == 1:
-            time.sleep(0.005)
+        with self._bus:
+            # ///////////////////////////////////////////////////////////////////
+            self._start_erase(self.ERASE_32KB_SUBSECTOR, 'erase_32kb', sector_address, self.SUBSECTOR_SIZE_OF_32KB)
+            # //////////////////////////////////////////////////////////////////
+            self.wait_ready('erase_32kb')
         return
     #added 21th April 2022
     def SECTOR_ERASE(self, sector_address):
         # Recibe la direccion del sector que se quiere borrar
-
-        cmd = [self.ERASE_SECTOR]
-
-        packet = cmd
-        # 読み込みアドレスを格納
-        data = (sector_address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (sector_address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & sector_address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        packet = packet
-
-        self.WRITE_ENABLE_OF()  # Funcion que habilita escritura en Own Flash
-
-        # ///////////////////////////////////////////////////////////////////
-        rcvdata = self.h.xfer2(packet)
-        # //////////////////////////////////////////////////////////////////
-        time.sleep(0.1)
-        while self.read_status_register() & 0x01 == 1:
-            time.sleep(0.05)
+        with self._bus:
+            # ///////////////////////////////////////////////////////////////////
+            self._start_erase(self.ERASE_SECTOR, 'erase_64kb', sector_address, self.SECTOR_SIZE)
+            # //////////////////////////////////////////////////////////////////
+            self.wait_ready('erase_64kb')
         return
     
     
+    # 他のスレッドの書き込み・消去が終わるまで待つ (self._lock の中で呼ぶ。待つ間はロックを放す)
+    def _wait_idle(self):
+        while self._busy_op is not None:
+            self._idle.wait()
+
+    # 消去コマンドを送る(完了は待たない)。size は消去単位
+    def _start_erase(self, cmd, op, address, size):
+        base = address - address % size
+        with self._lock:
+            self._wait_idle()
+            self.WRITE_ENABLE_OF()  # Funcion que habilita escritura en Own Flash
+            self._command_address(cmd, address)
+            self._busy_op = op
+            self._busy_range = (base, base + size)
+            self._mark_changed(base, size)
+            for sector in range(base // self.SECTOR_SIZE, -(-(base + size) // self.SECTOR_SIZE)):
+                self.erase_counts[sector] += 1
+                self._erase_deltas[sector] += 1
+            self._unsaved_erases += 1
+            self._invalidate(base, size)
+        # 消去中の待ち時間のうちに保存しておく
+        if self._unsaved_erases >= self.ERASE_COUNT_SAVE_EVERY:
+            self.save_erase_counts()
+
+    # 消去回数と書き込み・消去の記録(changed)をファイルに保存する
+    # ロックを取ってファイルを読み直し、他のプロセスが保存した分と合わせて書き戻す
+    #  - 消去回数: 前回の保存から増えた分を足す
+    #  - changed : 前回の保存から変えたサブセクタは、ファイルのどの番号より大きい番号に付け替え、
+    #              残りはサブセクタごとに大きい方を取る
+    # (他のプロセスが保存した分も erase_counts / changed に取り込まれる)
+    # (書きかけで壊れないよう、別名で書いてから置き換える)
+    def save_erase_counts(self):
+        with self._lock, counts_file_lock(self.erase_count_path):
+            counts = load_counts(self.erase_count_path, len(self.erase_counts))
+            for sector, delta in enumerate(self._erase_deltas):
+                if delta:
+                    counts[sector] += delta
+            saved_changes = load_counts(self.change_path, len(self.changed))
+            saved = self._saved_change_counter
+            stamp = max(max(saved_changes), self.change_counter) + 1
+            self.changed[:] = array('I', (stamp if mine > saved else max(mine, theirs)
+                                          for mine, theirs in zip(self.changed, saved_changes)))
+            files = ((self.erase_count_path, counts.tobytes()), (self.change_path, self.changed.tobytes()))
+            for path, data in files:
+                write_shared_file(path, data)
+            self.erase_counts = counts
+            self._erase_deltas = array('I', bytes(len(counts) * 4))
+            self._unsaved_erases = 0
+            self.change_counter = self._saved_change_counter = max(self.changed)
+
+    # address を含む64KBセクタの消去回数
+    def erase_count(self, address):
+        return self.erase_counts[address // self.SECTOR_SIZE]
+
+    # 消去回数の最小・最大・平均と、最も多いセクタのアドレス
+    def wear_stats(self):
+        counts = self.erase_counts
+        worst = max(range(len(counts)), key=counts.__getitem__)
+        return {
+            'min': min(counts),
+            'max': counts[worst],
+            'mean': sum(counts) / len(counts),
+            'worst_address': worst * self.SECTOR_SIZE,
+        }
+
+    # 実行中の消去を一時停止する (PROGRAM/ERASE SUSPEND 0x75)
+    # 一時停止できたら True (resume() で再開すること)。消去中でない・一時停止できない動作なら False
+    def suspend(self):
+        with self._lock:
+            if self._busy_op not in self.SUSPENDABLE_OPS:
+                return False
+            wait = self._last_resume + self.SUSPEND_MIN_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._xfer([self.PROGRAM_ERASE_SUSPEND])
+            t0 = time.monotonic()
+            # フラグステータスレジスタ bit7: 1=ready, bit6: 消去一時停止中
+            while True:
+                flag = self.read_flag_status_register()
+                if flag & 0x80:
+                    break
+                if time.monotonic() - t0 > self.SUSPEND_TIMEOUT:
+                    # 一時停止が遅れて効くと消去が止まったままになるので、再開を送ってから諦める
+                    self._xfer([self.PROGRAM_ERASE_RESUME])
+                    self._last_resume = time.monotonic()
+                    raise TimeoutError('erase suspend did not complete')
+            if not flag & 0x40:
+                # 一時停止する前に消去が終わっていた
+                return False
+            self._suspend_start = t0
+            return True
+
+    # 一時停止した消去を再開する (PROGRAM/ERASE RESUME 0x7A)
+    def resume(self):
+        with self._lock:
+            self._xfer([self.PROGRAM_ERASE_RESUME])
+            self._last_resume = time.monotonic()
+            self._paused_total += self._last_resume - self._suspend_start
+
+    # 消去中でも待たずに読む: 実行中の消去を一時停止して読み、すぐに再開する
+    # 消去中の範囲と重なる読み込みや、一時停止できない動作(ダイ消去)の最中は完了を待ってから読む
+    def read_urgent_into(self, address, buf):
+        view = memoryview(buf).cast('B')
+        start, end = address, address + len(view)
+        # キャッシュを通すときは cache_block 単位で読むので、重なりもブロックに揃えた範囲で見る
+        if self._cache is not None and len(view) <= self.cache_budget:
+            block = self.cache_block
+            start -= start % block
+            end += -end % block
+        with self._bus:
+            while True:
+                with self._lock:
+                    busy = self._busy_range
+                    overlap = busy is not None and start < busy[1] and busy[0] < end
+                    if not overlap and self.suspend():
+                        try:
+                            return self._read_ready(address, view)
+                        finally:
+                            self.resume()
+                    if self._read_status() & 0x01 == 0:
+                        return self._read_ready(address, view)
+                time.sleep(self.MIN_SLEEP)
+
+    def read_urgent(self, address, amount):
+        buf = bytearray(amount)
+        self.read_urgent_into(address, buf)
+        return buf
+
+    # アドレスを含むダイ(64MB)全体を消去する
+    def DIE_ERASE_OF(self, die_address):
+        with self._bus:
+            self._start_erase(self.DIE_ERASE, 'die_erase', die_address, self.DIE_SIZE)
+            self.wait_ready('die_erase')
+        return
+
+    # start から length バイト(4KB境界に揃っていること)を消去する手順を作る
+    # 戻り値は (動作名, アドレス, サイズ) のリスト
+    # 大きい単位は、小さい単位で同じ範囲を消すより速いと見込めるときだけ使う
+    def plan_erase(self, start, length):
+        unit = self.SUBSECTOR_SIZE_OF_4KB
+        if start % unit or length % unit:
+            raise ValueError('erase range must be 4KB aligned: 0x{:x} + 0x{:x}'.format(start, length))
+        if start < 0 or start + length > self.FLASH_SIZE:
+            raise ValueError('erase range out of flash: 0x{:x} + 0x{:x}'.format(start, length))
+        # 各単位を最速の組み合わせで消したときの推定時間
+        usable = []
+        best = None
+        for size, op in self.ERASE_UNITS:
+            cost = self.busy_estimate[op]
+            if best is None or cost <= best[1] * (size // best[0]):
+                usable.append((size, op))
+                best = (size, cost)
+            else:
+                best = (size, best[1] * (size // best[0]))
+        usable.reverse()
+        plan = []
+        address = start
+        end = start + length
+        while address < end:
+            for size, op in usable:
+                if address % size == 0 and address + size <= end:
+                    plan.append((op, address, size))
+                    address += size
+                    break
+        return plan
+
+    # 消去にかかる時間の見込み[s] (busy_estimate から計算)
+    def estimate_erase_time(self, start, length):
+        return sum(self.busy_estimate[op] for op, _, _ in self.plan_erase(start, length))
+
+    # start から length バイトを最少・最速の消去コマンドの組み合わせで消去する
+    # 戻り値は transfer_stats
+    def erase_range(self, start, length):
+        with self.lock:
+            t0 = time.monotonic()
+            for op, address, _ in self.plan_erase(start, length):
+                self._erase_unit(op, address)
+            elapsed = time.monotonic() - t0
+            return transfer_stats(length, elapsed, length / elapsed if elapsed > 0 else 0.0)
+
+    # plan_erase の1つ分を消去する
+    def _erase_unit(self, op, address):
+        erase = {
+            'erase_4kb': self.SUBSECTOR_4KB_ERASE_OF,
+            'erase_32kb': self.SUBSECTOR_32KB_ERASE_OF,
+            'erase_64kb': self.SECTOR_ERASE,
+            'die_erase': self.DIE_ERASE_OF,
+        }
+        erase[op](address)
+
+    # src から dst へ length バイトをコピーする。戻り値は transfer_stats
+    # chunk_size のバッファ2つを交互に使い、読み込みスレッドが次のチャンクを読む間にこちらで書き込む
+    #  - dst 側で丸ごと含まれる4KBは plan_erase の順に、そこへ書き込む直前に消去する
+    #    (消去中の読み込みは read_urgent_into で消去を一時停止して割り込む)
+    #  - 4KBに満たない先頭・末尾は update_bytes で周りを残して書く
+    # src と dst の範囲が重なっていてはいけない
+    def copy_range(self, src, dst, length, chunk_size=0x10000):
+        if src < dst + length and dst < src + length:
+            raise ValueError('copy ranges overlap: 0x{:x} -> 0x{:x} (0x{:x} bytes)'.format(src, dst, length))
+        unit = self.SUBSECTOR_SIZE_OF_4KB
+        end = dst + length
+        body_start = min(dst + (-dst % unit), end)
+        body_end = max(end - end % unit, body_start)
+        erase_plan = collections.deque(self.plan_erase(body_start, body_end - body_start)
+                                       if body_end > body_start else ())
+        # dst 側のオフセットで区切ったチャンク (先頭・末尾の端数は別のチャンクにする)
+        chunks = []
+        for start, stop in ((dst, body_start), (body_start, body_end), (body_end, end)):
+            for a in range(start, stop, chunk_size):
+                chunks.append((a - dst, min(chunk_size, stop - a)))
+
+        buffers = (bytearray(chunk_size), bytearray(chunk_size))
+        free = queue.Queue()
+        filled = queue.Queue()
+        for i in range(len(buffers)):
+            free.put(i)
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for offset, n in chunks:
+                    i = free.get()
+                    if stop.is_set():
+                        return
+                    self.read_urgent_into(src + offset, memoryview(buffers[i])[:n])
+                    filled.put((i, offset, n))
+            except Exception as e:
+                filled.put(e)
+
+        with self.lock:
+            t0 = time.monotonic()
+            thread = threading.Thread(target=reader, name='flash_copy_reader', daemon=True)
+            thread.start()
+            try:
+                for _ in chunks:
+                    item = filled.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    i, offset, n = item
+                    a = dst + offset
+                    data = memoryview(buffers[i])[:n]
+                    if body_start <= a < body_end:
+                        while erase_plan and erase_plan[0][1] < a + n:
+                            op, address, _ = erase_plan.popleft()
+                            self._erase_unit(op, address)
+                        self.write_bytes(a, data)
+                    else:
+                        self.update_bytes(a, data)
+                    free.put(i)
+            finally:
+                stop.set()
+                free.put(None)
+                thread.join()
+            elapsed = time.monotonic() - t0
+        return transfer_stats(length, elapsed, length / elapsed if elapsed > 0 else 0.0)
+
     def WRITE_ENABLE_OF(self):
         # /////////////////////////////////////////////////////////////
         # //delay_ms(2);
         packet = [self.ENABLE_WRITE]
-        self.h.xfer2(packet)  # //Send 0x06
+        self._xfer(packet)  # //Send 0x06
         # /////////////////////////////////////////////////////////////
 
         return
@@ -305,83 +1200,72 @@ class flash:
     # [memo 11/10 20:06 h.m]read_data_bytes_smfは、packetの生成は出来てるっぽいけど、肝心の受信がうまく行かない
     #may be max 256 due to data buffer size in flash
     def WRITE_DATA_BYTE_SMF(self, address, write_data):
-        cmd = [self.WRITE_PAGE]
-        packet = cmd
-
-        data = (address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-        # 書き込むバイト数を定義
-        packet = packet + [write_data]
-        # SMFに書き込み
-        self.WRITE_ENABLE_OF()
-        sleep(0.00001)
-
-        # ////////////////////////////////////////////////////////////////
-
-        self.h.xfer2(packet)
-        # ////////////////////////////////////////////////////////////////
-        time.sleep(0.0001)        
-        while self.read_status_register() & 0x01 == 1:
-            time.sleep(0.0001)
-
+        self.write_page(address, bytes((write_data,)))
         return
 
     # SMFに多バイト書き込む
-    #page_address = page address,  write_date is list
+    #page_address = page address,  write_date is list (bytes/bytearray も可)
     def WRITE_DATA_BYTES_SMF(self, address, write_data):
-        cmd = self.WRITE_PAGE
-        packet = [cmd]
-
-        data = (address >> 24) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (address >> 16) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = (address >> 8) & 0xff
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-
-        data = 0xff & address
-        #packet = b""
-        hexdata = (b'' + data.to_bytes(1, 'big'))
-        packet += hexdata
-        # 書き込むバイト数を定義
-        #for j in write_data:
-        #    packet = packet + [j]
-        packet = packet + write_data
-        #print ("write start")            
-        # SMFに書き込み
-        self.WRITE_ENABLE_OF()
-        sleep(0.0000001)
-        #print(packet[-1])
-        # ////////////////////////////////////////////////////////////////
-
-        self.h.writebytes2(packet)
-        # ////////////////////////////////////////////////////////////////
-
-        time.sleep(0.0001)
-        while self.read_status_register() & 0x01 == 1:
-            time.sleep(0.0001)
+        if isinstance(write_data, list):
+            write_data = bytes(write_data)
+        self.write_page(address, write_data)
         return
 
 
+    # ステータスレジスタを読む(ポーリング用、表示なし)
+    def _read_status(self):
+        return self._xfer([self.READ_STATUS_REG, 0x00])[1]
+
+    # 書き込み/消去の完了(WIP=0)を待つ。戻り値は待ち時間[s]
+    # 推定完了時間の8割までは寝て、その後は推定時間/50 間隔でポーリングする
+    # 推定時間は実測値で更新される。timeout[s]を超えたら TimeoutError
+    # (最初の確認で終わっていたら、待ち時間は自分で寝た時間なので実測にならない。そのときは推定を半分にする)
+    # (ポーリング中は何も表示しない。一時停止していた時間は数えない)
+    def wait_ready(self, op, start=None, timeout=None):
+        typ, tmax = self.BUSY_TIMES[op]
+        if start is None:
+            start = time.monotonic()
+        if timeout is None:
+            timeout = tmax * self.BUSY_TIMEOUT_MARGIN
+        paused_base = self._paused_total
+        estimate = self.busy_estimate[op]
+        first_poll = start + estimate * 0.8 - time.monotonic()
+        if first_poll >= self.MIN_SLEEP:
+            time.sleep(first_poll)
+        interval = estimate / self.BUSY_POLL_DIVISION
+        saw_busy = False
+        try:
+            while True:
+                # 読む前の時刻で判定する(読んだ後に待たされても、その間の時間でタイムアウトにしない)
+                now = time.monotonic()
+                with self._lock:
+                    if self._read_status() & 0x01 == 0:
+                        break
+                saw_busy = True
+                if now - start - (self._paused_total - paused_base) > timeout:
+                    raise TimeoutError('flash busy for more than {:.3f} s ({})'.format(timeout, op))
+                if interval >= self.MIN_SLEEP:
+                    time.sleep(interval)
+        finally:
+            with self._lock:
+                self._busy_op = self._busy_range = None
+                self._idle.notify_all()
+        elapsed = time.monotonic() - start - (self._paused_total - paused_base)
+        if self.instrument is not None:
+            self.instrument.record_busy(op, elapsed)
+        if saw_busy:
+            estimate += (elapsed - estimate) * self.BUSY_ADAPT_RATE
+        else:
+            estimate *= 0.5
+        self.busy_estimate[op] = min(max(estimate, typ / 10), tmax)
+        return elapsed
+
+    #bit7 program/erase controller 1 = ready
+    #bit6 erase suspend, bit2 program suspend
+    def read_flag_status_register(self):
+        with self._bus:
+            return self._xfer([self.READ_FLAG_STATUS_REG, 0x00])[1]
+
     #bit7 Status register write enable/disable
     #bit5 top/ bottom 0=top(default), 1= bottom
     #bit6,4:2 see protected area tables
@@ -390,16 +1274,39 @@ class flash:
     def read_status_register(self):
         cmd = self.READ_STATUS_REG
         packet = [cmd,0x00]        
-        rcvdata = self.h.xfer2(packet)
+        with self._bus:
+            rcvdata = self._xfer(packet)
         #print("Status register: " + str(rcvdata[1]))
-        if rcvdata[1] & 0x01 == 1 :
-            print("busy")
-        
-        
-        
         return rcvdata[1]
 
 
+
+# 同じ (bus, CSB) にはプロセス内で1つの flash を使う(spidevを開いて設定するのは最初の1回だけ)
+# 引数は最初に開くときだけ使われる。閉じるのは close_shared (プロセス終了時にも呼ばれる)
+# 共有しているものを with や close() で閉じないこと
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_flash(bus=0, CSB=0, **kwargs):
+    with _shared_lock:
+        handle = _shared.get((bus, CSB))
+        if handle is None or handle.closed:
+            handle = _shared[(bus, CSB)] = flash(bus, CSB, **kwargs)
+        return handle
+
+
+def close_shared():
+    with _shared_lock:
+        handles = list(_shared.values())
+        _shared.clear()
+    for handle in handles:
+        handle.close()
+
+
+atexit.register(close_shared)
+
+
 if __name__ == '__main__':
 
     Flash = flash()
@@ -419,7 +1326,22 @@ if __name__ == '__main__':
                 sleep(1)
                 data = Flash.read_chip_id()
                 print(data)
+
+            # SPIクロックの自動調整 (0x07FFE000 の4KBを使う)
+            elif keydata == 'k':
+                result = Flash.calibrate_clock()
+                for hz, ok in result['results']:
+                    print(hz, "OK" if ok else "NG")
+                print("max", result['max_ok_hz'], "Hz, use", result['safe_hz'], "Hz")
             
+            # 領域のコピー
+            elif keydata == 'p':
+                src = int(input("source address (hex)\n"), 16)
+                dst = int(input("destination address (hex)\n"), 16)
+                length = int(input("length (hex)\n"), 16)
+                result = Flash.copy_range(src, dst, length)
+                print(f"copied {result.nbytes} bytes in {result.seconds:.3f} s ({result.bytes_per_sec / 1e6:.3f} MB/s)")
+
             elif keydata == 'r':
 
                 print("read Start")
@@ -473,4 +1395,5 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         pass
 
-    GPIO.cleanup()
+    if GPIO is not None:
+        GPIO.cleanup()
@@ -0,0 +1,106 @@
+# MT25QL01GBBB_arbiter.py
+# 複数のプロセスから同じ spidev (フラッシュ) を使うときのバス調停
+#
+# ロックファイルを flock して、コマンドのひとまとまり (WREN+書き込み+完了待ち など) の間だけ
+# バスを占有する。同じプロセス内のスレッドどうしはロックを共有する(入れ子に取れる)ので、
+# プロセス内の順番は flash 側のロックで決める
+# 待たされた時間(競合)は stats() で見られる
+
+# -*- coding: utf-8 -*-
+import os
+import time
+import fcntl
+import threading
+
+
+LOCK_DIR = '/tmp'
+
+
+def lock_path(bus, device):
+    return os.path.join(LOCK_DIR, 'spidev{}.{}.lock'.format(bus, device))
+
+
+# ロックファイルを開く(flock は読み込み専用でも取れる)
+# sudo で動かしたプロセスが作っても他のユーザーが開けるよう、umask によらず 0666 にする
+# (/tmp では他のユーザーのファイルを O_CREAT で開けないことがあるので、あればそのまま開く)
+def open_lock_file(path):
+    try:
+        return os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+    try:
+        os.fchmod(fd, 0o666)
+    except OSError:
+        # 他のユーザーが先に作っていた
+        pass
+    return fd
+
+
+class bus_arbiter:
+    def __init__(self, path):
+        self.path = path
+        self._fd = open_lock_file(path)
+        self._mutex = threading.Lock()
+        self._count = 0
+        self._held_since = 0.0
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = self.wait_max = 0.0
+        self.hold_total = self.hold_max = 0.0
+
+    def acquire(self):
+        with self._mutex:
+            if self._count == 0:
+                t0 = time.monotonic()
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # 他のプロセスが使っている
+                    self.contended += 1
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                self._held_since = time.monotonic()
+                wait = self._held_since - t0
+                self.acquisitions += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            self._count += 1
+
+    def release(self):
+        with self._mutex:
+            self._count -= 1
+            if self._count == 0:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                hold = time.monotonic() - self._held_since
+                self.hold_total += hold
+                self.hold_max = max(self.hold_max, hold)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    # 取得回数、待たされた回数、待ち時間・占有時間の合計と最大[s]
+    def stats(self):
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+            'hold_total': self.hold_total,
+            'hold_max': self.hold_max,
+        }
+
+
+# 同じロックファイルにはプロセス内で1つの bus_arbiter を使う
+_arbiters = {}
+_arbiters_lock = threading.Lock()
+
+
+def get_arbiter(path):
+    with _arbiters_lock:
+        if path not in _arbiters:
+            _arbiters[path] = bus_arbiter(path)
+        return _arbiters[path]
@@ -0,0 +1,207 @@
+# MT25QL01GBBB_benchmark.py
+# MT25QL01GBBB_20231023.flash の性能測定
+#
+# 実機でもエミュレータ(MT25Q_EMULATOR)でも同じ手順で測り、結果をJSONに書き出す
+#  - 読み込み: 読み込みコマンド(read/fast/dual/quad) × チャンクサイズごとのスループット
+#  - 書き込み: ページ境界に揃えた場合と揃えない場合のスループット
+#  - 消去    : 4KB/32KB/64KB それぞれ1回あたりの時間 (ダイ消去は時間がかかるので測らない)
+#  - 小さい操作: ステータス読み出し、ID読み出し、1バイト読み込み、1バイト書き込みの待ち時間
+# 書き込むデータは seed から作るので、同じ seed なら毎回同じ内容になる
+#
+# 使い方:
+#   python3 MT25QL01GBBB_benchmark.py -o bench.json
+#   python3 MT25QL01GBBB_benchmark.py -o bench_new.json --compare bench.json
+#
+# 注意: --address から --length バイト(既定は 0x07E00000 からの1MB)は消去・上書きされる
+
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import datetime
+import statistics
+
+import MT25QL01GBBB_20231023 as MT25QL01GBBB
+
+
+BENCH_ADDRESS = 0x07E00000
+BENCH_LENGTH = 0x00100000
+READ_CHUNK_SIZES = (256, 1024, 4096, 16384, 65536)
+READ_LENGTH = 0x40000
+PROGRAM_LENGTH = 0x10000
+UNALIGNED_OFFSET = 0x80
+SMALL_OP_REPEATS = 200
+
+
+def summarize(name, times, nbytes=0, **extra):
+    times = sorted(times)
+    median = statistics.median(times)
+    result = {
+        'name': name,
+        'repeats': len(times),
+        'bytes': nbytes,
+        'min_s': times[0],
+        'median_s': median,
+        'p99_s': times[min(len(times) - 1, int(len(times) * 0.99))],
+        'max_s': times[-1],
+    }
+    if nbytes:
+        result['mb_per_s'] = nbytes / median / 1e6 if median > 0 else 0.0
+    result.update(extra)
+    return result
+
+
+def timed(func, repeats, prepare=None):
+    times = []
+    for _ in range(repeats):
+        if prepare is not None:
+            prepare()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+class benchmark:
+    def __init__(self, flash, address=BENCH_ADDRESS, length=BENCH_LENGTH, repeats=5, seed=0):
+        if address % flash.SECTOR_SIZE or length % flash.SECTOR_SIZE:
+            raise ValueError('benchmark area must be 64KB aligned: 0x{:x} + 0x{:x}'.format(address, length))
+        if length < READ_LENGTH or length < PROGRAM_LENGTH + flash.SECTOR_SIZE:
+            raise ValueError('benchmark area too small: 0x{:x}'.format(length))
+        self.flash = flash
+        self.address = address
+        self.length = length
+        self.repeats = repeats
+        self.seed = seed
+        self.results = []
+
+    def _data(self, length):
+        return random.Random(self.seed).getrandbits(8 * length).to_bytes(length, 'little')
+
+    def _add(self, result):
+        self.results.append(result)
+        rate = ' {:8.3f} MB/s'.format(result['mb_per_s']) if 'mb_per_s' in result else ''
+        print('{:36s} median {:10.1f} us{}'.format(result['name'], result['median_s'] * 1e6, rate))
+
+    def run(self):
+        self.flash.disable_cache()
+        self.bench_erase()
+        self.bench_program()
+        self.bench_read()
+        self.bench_small_ops()
+        return self.results
+
+    def bench_read(self):
+        flash = self.flash
+        flash.update_bytes(self.address, self._data(READ_LENGTH))
+        saved = flash.read_mode
+        try:
+            for mode in flash.READ_MODES:
+                # 2線/4線が使えない環境では set_read_mode が 'read' に戻すので測らない
+                if flash.set_read_mode(mode) != mode:
+                    self.results.append({'name': 'read_{}'.format(mode), 'skipped': 'not supported'})
+                    print('{:36s} skipped (not supported)'.format('read_' + mode))
+                    continue
+                for chunk_size in READ_CHUNK_SIZES:
+                    buf = bytearray(chunk_size)
+
+                    def read_all():
+                        for _ in flash.read_chunks(self.address, READ_LENGTH, buf=buf):
+                            pass
+                    times = timed(read_all, self.repeats)
+                    self._add(summarize('read_{}_{}'.format(mode, chunk_size), times, READ_LENGTH,
+                                        mode=mode, chunk_size=chunk_size))
+        finally:
+            flash.set_read_mode(saved)
+
+    def bench_program(self):
+        flash = self.flash
+        data = self._data(PROGRAM_LENGTH)
+        for name, offset in (('program_aligned', 0), ('program_unaligned', UNALIGNED_OFFSET)):
+            address = self.address + offset
+            # 消去は測定に含めない
+            times = timed(lambda: flash.write_bytes(address, data), self.repeats,
+                          prepare=lambda: flash.erase_range(self.address, PROGRAM_LENGTH + flash.SECTOR_SIZE))
+            self._add(summarize(name, times, PROGRAM_LENGTH, offset=offset))
+
+    def bench_erase(self):
+        flash = self.flash
+        erase = {
+            'erase_4kb': flash.SUBSECTOR_4KB_ERASE_OF,
+            'erase_32kb': flash.SUBSECTOR_32KB_ERASE_OF,
+            'erase_64kb': flash.SECTOR_ERASE,
+        }
+        for size, op in flash.ERASE_UNITS:
+            if op not in erase:
+                continue
+            # 消去済みのブロックは速く終わることがあるので、毎回書き込んでから消す
+            fill = self._data(min(size, 0x1000))
+            times = timed(lambda: erase[op](self.address), self.repeats,
+                          prepare=lambda: flash.write_bytes(self.address, fill))
+            self._add(summarize(op, times, size))
+
+    def bench_small_ops(self):
+        flash = self.flash
+        repeats = SMALL_OP_REPEATS
+        one = bytearray(1)
+        flash.erase_range(self.address, flash.SUBSECTOR_SIZE_OF_4KB)
+        addresses = iter(range(self.address, self.address + flash.SUBSECTOR_SIZE_OF_4KB))
+        ops = (
+            ('read_status', flash._read_status),
+            ('read_id', flash._read_id),
+            ('read_1byte', lambda: flash.read_into(self.address, one)),
+            ('program_1byte', lambda: flash.write_page(next(addresses), b'\x00')),
+        )
+        for name, func in ops:
+            self._add(summarize(name, timed(func, repeats)))
+
+
+def environment(flash):
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'backend': 'emulator' if os.environ.get(MT25QL01GBBB.EMULATOR_ENV) else 'spidev',
+        'time_scale': os.environ.get('MT25Q_EMULATOR_TIME_SCALE'),
+        'max_speed_hz': flash.h.max_speed_hz,
+        'max_transfer': flash.max_transfer,
+        'python': sys.version.split()[0],
+    }
+
+
+# 前回の結果と比べて、中央値の比(今回/前回)を表示する
+def compare(results, path):
+    with open(path) as f:
+        previous = {r['name']: r for r in json.load(f)['results']}
+    print('\ncompared with {}'.format(path))
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None or 'median_s' not in old or 'median_s' not in result:
+            continue
+        ratio = result['median_s'] / old['median_s'] if old['median_s'] > 0 else float('inf')
+        print('{:36s} {:10.1f} us -> {:10.1f} us  x{:.3f}'.format(
+            result['name'], old['median_s'] * 1e6, result['median_s'] * 1e6, ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MT25QL01GBBB benchmark')
+    parser.add_argument('-o', '--output', default='MT25QL01GBBB_benchmark.json')
+    parser.add_argument('--address', type=lambda s: int(s, 0), default=BENCH_ADDRESS)
+    parser.add_argument('--length', type=lambda s: int(s, 0), default=BENCH_LENGTH)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baud', type=int, default=None)
+    parser.add_argument('--compare', default=None, help='previous result file')
+    args = parser.parse_args()
+
+    Flash = MT25QL01GBBB.get_flash(baud=args.baud)
+    bench = benchmark(Flash, args.address, args.length, args.repeats, args.seed)
+    results = bench.run()
+    report = dict(environment(Flash), address=args.address, length=args.length,
+                  repeats=args.repeats, seed=args.seed, results=results)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('written to {}'.format(args.output))
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,223 @@
+# MT25QL01GBBB_emulator.py
+# spidev.SpiDev の代わりに使える MT25QL01GBB のエミュレータ
+# 128MBのイメージファイルをmmapして、実機なしでフラッシュ関係のツールを動かす・計測するためのもの
+#
+# 使い方:
+#   MT25Q_EMULATOR=/tmp/mt25q.img python3 memory_test.py
+#   (MT25QL01GBBB_20231023.flash が spidev の代わりにこのモジュールの SpiDev を使う)
+#   MT25Q_EMULATOR_TIME_SCALE=0 にするとビジー時間を 0 にする(既定は 1.0 = データシートのtyp)
+#
+# 対応コマンド: 0x9F, 0x05, 0x70, 0x06, 0x13, 0x0C, 0x12, 0x21, 0x5C, 0xDC, 0xC4, 0x75, 0x7A
+# 書き込みはページ(256バイト)内で折り返し、1→0 の変化だけが反映される
+
+# -*- coding: utf-8 -*-
+import os
+import mmap
+import time
+
+
+FLASH_SIZE = 0x8000000
+DIE_SIZE = 0x4000000
+PAGE_SIZE = 256
+
+READ_ID = 0x9F
+READ_STATUS_REG = 0x05
+ENABLE_WRITE = 0x06
+READ_DATA_BYTES = 0x13
+FAST_READ = 0x0C
+WRITE_PAGE = 0x12
+ERASE_4KB_SUBSECTOR = 0x21
+ERASE_32KB_SUBSECTOR = 0x5C
+ERASE_SECTOR = 0xDC
+DIE_ERASE = 0xC4
+READ_FLAG_STATUS_REG = 0x70
+PROGRAM_ERASE_SUSPEND = 0x75
+PROGRAM_ERASE_RESUME = 0x7A
+
+# 消去コマンドと消去サイズ
+ERASE_SIZES = {
+    ERASE_4KB_SUBSECTOR: 0x1000,
+    ERASE_32KB_SUBSECTOR: 0x8000,
+    ERASE_SECTOR: 0x10000,
+    DIE_ERASE: DIE_SIZE,
+}
+
+# コマンドごとのビジー時間 [s] (データシートのtyp)
+BUSY_TIMES = {
+    WRITE_PAGE: 0.00012,
+    ERASE_4KB_SUBSECTOR: 0.05,
+    ERASE_32KB_SUBSECTOR: 0.1,
+    ERASE_SECTOR: 0.15,
+    DIE_ERASE: 153.0,
+}
+
+# Manufacturer ID, Memory type, Memory capacity, EDID
+CHIP_ID = bytes([0x20, 0xBA, 0x21, 0x10])
+
+
+# イメージファイルを(なければ消去状態 0xFF で)作る
+def create_image(path, size=FLASH_SIZE):
+    block = b'\xff' * 0x100000
+    with open(path, 'wb') as f:
+        for offset in range(0, size, len(block)):
+            f.write(block[:min(len(block), size - offset)])
+
+
+class SpiDev:
+    # image: イメージファイルのパス。None なら環境変数 MT25Q_EMULATOR を使う
+    def __init__(self, image=None, size=FLASH_SIZE, time_scale=None):
+        if image is None:
+            image = os.environ['MT25Q_EMULATOR']
+        if time_scale is None:
+            time_scale = float(os.environ.get('MT25Q_EMULATOR_TIME_SCALE', '1.0'))
+        self.image = image
+        self.size = size
+        self.time_scale = time_scale
+        self.busy_times = dict(BUSY_TIMES)
+
+        # spidev と同じ属性
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.bits_per_word = 8
+        self.cshigh = False
+        self.lsbfirst = False
+        self.threewire = False
+        self.loop = False
+        self.no_cs = False
+
+        self.mm = None
+        self._file = None
+        self.write_enable = False
+        self.busy_until = 0.0
+        self.busy_cmd = None
+        # 一時停止中のコマンドと残りのビジー時間
+        self.suspended_cmd = None
+        self.suspended_remaining = 0.0
+
+    def open(self, bus, device):
+        if not os.path.exists(self.image) or os.path.getsize(self.image) < self.size:
+            create_image(self.image, self.size)
+        self._file = open(self.image, 'r+b')
+        self.mm = mmap.mmap(self._file.fileno(), self.size)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def busy(self):
+        return time.monotonic() < self.busy_until
+
+    def _start_busy(self, cmd):
+        self.busy_until = time.monotonic() + self.busy_times[cmd] * self.time_scale
+        self.busy_cmd = cmd
+        self.write_enable = False
+
+    # CSを下げてから上げるまでの1回の転送を処理し、MISOの内容を返す
+    def transaction(self, data):
+        data = bytes(data)
+        if not data:
+            return b''
+        cmd = data[0]
+        if cmd == READ_STATUS_REG:
+            status = (0x01 if self.busy() else 0x00) | (0x02 if self.write_enable else 0x00)
+            return b'\x00' + bytes([status]) * (len(data) - 1)
+        if cmd == READ_FLAG_STATUS_REG:
+            flag = 0x00 if self.busy() else 0x80
+            if self.suspended_cmd == WRITE_PAGE:
+                flag |= 0x04
+            elif self.suspended_cmd is not None:
+                flag |= 0x40
+            return b'\x00' + bytes([flag]) * (len(data) - 1)
+        if cmd == PROGRAM_ERASE_SUSPEND:
+            # ダイ消去は一時停止できない
+            if self.busy() and self.busy_cmd != DIE_ERASE and self.suspended_cmd is None:
+                now = time.monotonic()
+                self.suspended_cmd = self.busy_cmd
+                self.suspended_remaining = self.busy_until - now
+                self.busy_until = now
+            return bytes(len(data))
+        if cmd == PROGRAM_ERASE_RESUME:
+            if self.suspended_cmd is not None and not self.busy():
+                self.busy_until = time.monotonic() + self.suspended_remaining
+                self.busy_cmd = self.suspended_cmd
+                self.suspended_cmd = None
+            return bytes(len(data))
+        if self.busy():
+            # 書き込み/消去中はステータス読み出し以外を受け付けない
+            return bytes(len(data))
+        if cmd == READ_ID:
+            return (b'\x00' + CHIP_ID + bytes(16))[:len(data)].ljust(len(data), b'\x00')
+        if cmd == ENABLE_WRITE:
+            self.write_enable = True
+            return bytes(len(data))
+        if len(data) < 5:
+            return bytes(len(data))
+        address = int.from_bytes(data[1:5], 'big') % self.size
+        if cmd == READ_DATA_BYTES:
+            return bytes(5) + self._read(address, len(data) - 5)
+        if cmd == FAST_READ:
+            # ダミー1バイトのあとからデータが出る
+            return bytes(6) + self._read(address, max(len(data) - 6, 0))
+        if cmd == WRITE_PAGE and self.write_enable:
+            self._program(address, data[5:])
+            self._start_busy(cmd)
+        elif cmd in ERASE_SIZES and self.write_enable:
+            unit = ERASE_SIZES[cmd]
+            start = address - address % unit
+            self._fill(start, unit)
+            self._start_busy(cmd)
+        return bytes(len(data))
+
+    # アドレスの終わりまで来たら 0 番地に戻って読み続ける
+    def _read(self, address, length):
+        out = bytearray()
+        while length:
+            n = min(length, self.size - address)
+            out += self.mm[address:address + n]
+            address = (address + n) % self.size
+            length -= n
+        return bytes(out)
+
+    def _fill(self, start, length):
+        block = b'\xff' * min(length, 0x100000)
+        for offset in range(start, start + length, len(block)):
+            self.mm[offset:offset + len(block)] = block
+
+    # ページ内で折り返しながら書き込む(256バイトを超えた分は後ろの256バイトが残る)
+    def _program(self, address, payload):
+        base = address - address % PAGE_SIZE
+        column = address % PAGE_SIZE
+        if len(payload) > PAGE_SIZE:
+            column = (column + len(payload) - PAGE_SIZE) % PAGE_SIZE
+            payload = payload[-PAGE_SIZE:]
+        while payload:
+            n = min(PAGE_SIZE - column, len(payload))
+            start = base + column
+            old = int.from_bytes(self.mm[start:start + n], 'little')
+            new = int.from_bytes(payload[:n], 'little')
+            self.mm[start:start + n] = (old & new).to_bytes(n, 'little')
+            payload = payload[n:]
+            column = 0
+
+    # spidev と同じインターフェース
+    def xfer(self, data, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        return list(self.transaction(data))
+
+    def xfer2(self, data, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        return list(self.transaction(data))
+
+    def xfer3(self, data, speed_hz=0, delay_usecs=0, bits_per_word=0):
+        return tuple(self.transaction(data))
+
+    def writebytes(self, data):
+        self.transaction(data)
+
+    def writebytes2(self, data):
+        self.transaction(data)
+
+    def readbytes(self, length):
+        return [0] * length
@@ -0,0 +1,169 @@
+# MT25QL01GBBB_image.py
+# フラッシュ全体(または領域のリスト)をイメージファイルに吸い出す
+#
+# 大きなチャンク(IMAGE_CHUNK)で順に読み、使い回しのバッファからそのままファイルに書く
+# 各領域はイメージファイルの中でもフラッシュと同じオフセットに置く(領域だけなら残りは穴のまま)
+# 読みながら sha256 を計算し、CHECKPOINT_INTERVAL ごとに
+#   ファイルを fsync → 進み具合(読み終えたバイト数と、そこまでの sha256)を <イメージ>.progress に書く
+# 途中で止まったら、次はイメージファイルの読み終えた部分から sha256 を計算し直して、
+# 記録と一致すればその続きから読む(一致しなければ最初から。そのときはファイルも作り直す)
+# sha256 は読んだ領域を順につなげたもの。全体を吸い出したときだけイメージファイルの sha256 と同じになる
+#
+# 使い方:
+#   python3 MT25QL01GBBB_image.py chip.img                        # 128MB 全体
+#   python3 MT25QL01GBBB_image.py corn.img --region CORN_MSN_DATA --region CORN_MSN_HEAD_DATA
+#   python3 MT25QL01GBBB_image.py part.img --range 0x05B60000:0x7E0000
+
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import datetime
+
+
+IMAGE_CHUNK = 0x100000
+CHECKPOINT_INTERVAL = 0x800000
+FILE_BUFFER_SIZE = 0x100000
+
+
+class device_image:
+    def __init__(self, flash, path, regions=None, chunk_size=IMAGE_CHUNK, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.flash = flash
+        self.path = path
+        self.progress_path = path + '.progress'
+        self.regions = [(0, flash.FLASH_SIZE)] if not regions else [(int(a), int(n)) for a, n in regions]
+        for address, length in self.regions:
+            if address < 0 or length <= 0 or address + length > flash.FLASH_SIZE:
+                raise ValueError('region out of range: 0x{:x} + 0x{:x}'.format(address, length))
+        self.total = sum(length for _, length in self.regions)
+        self.chunk_size = chunk_size
+        self.checkpoint_interval = checkpoint_interval
+
+    # 前回の進み具合を読み、イメージファイルの中身と sha256 が合えば (読み終えたバイト数, hash) を返す
+    def _resume(self):
+        try:
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return 0, hashlib.sha256()
+        if [tuple(r) for r in progress.get('regions', ())] != self.regions:
+            return 0, hashlib.sha256()
+        done = progress.get('done', 0)
+        digest = hashlib.sha256()
+        try:
+            with open(self.path, 'rb') as f:
+                for address, length in self._pieces(0, done):
+                    f.seek(address)
+                    while length:
+                        data = f.read(min(length, FILE_BUFFER_SIZE))
+                        if not data:
+                            return 0, hashlib.sha256()
+                        digest.update(data)
+                        length -= len(data)
+        except OSError:
+            return 0, hashlib.sha256()
+        if digest.hexdigest() != progress.get('sha256'):
+            return 0, hashlib.sha256()
+        return done, digest
+
+    # 全領域を続けたときの start から end バイト目までを (フラッシュのアドレス, 長さ) に分ける
+    def _pieces(self, start, end):
+        position = 0
+        for address, length in self.regions:
+            lo = max(start, position)
+            hi = min(end, position + length)
+            if lo < hi:
+                yield address + lo - position, hi - lo
+            position += length
+
+    def _save_progress(self, done, digest, complete=False):
+        progress = {
+            'regions': self.regions,
+            'done': done,
+            'total': self.total,
+            'sha256': digest.hexdigest(),
+            'complete': complete,
+            'date': datetime.datetime.now().isoformat(),
+        }
+        tmp = self.progress_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(progress, f, indent=1)
+        os.replace(tmp, self.progress_path)
+
+    # 吸い出す。resume=False なら前回の続きからではなく最初から
+    # report(読み終えたバイト数, 全体, 経過時間[s], 今回読み始めたバイト数) をチェックポイントごとに呼ぶ
+    # 戻り値は全体の sha256 (16進)
+    def run(self, resume=True, report=None):
+        done, digest = self._resume() if resume else (0, hashlib.sha256())
+        buf = bytearray(self.chunk_size)
+        # 最初から読むときは前のファイルを残さない(領域だけのとき、穴に古い中身が残らないように)
+        mode = 'r+b' if done else 'w+b'
+        t0 = time.monotonic()
+        start = done
+        with open(self.path, mode, buffering=FILE_BUFFER_SIZE) as f:
+            next_checkpoint = done + self.checkpoint_interval
+            for address, length in self._pieces(done, self.total):
+                f.seek(address)
+                for chunk in self.flash.read_chunks(address, length, buf=buf):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    done += len(chunk)
+                    if done >= next_checkpoint:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        self._save_progress(done, digest)
+                        next_checkpoint = done + self.checkpoint_interval
+                        if report is not None:
+                            report(done, self.total, time.monotonic() - t0, start)
+            # 領域だけのときも、最後の領域の終わりまでファイルの長さを揃える
+            f.truncate(max(os.fstat(f.fileno()).st_size, max(a + n for a, n in self.regions)))
+            f.flush()
+            os.fsync(f.fileno())
+        self._save_progress(done, digest, complete=True)
+        if report is not None and done + self.checkpoint_interval != next_checkpoint:
+            report(done, self.total, time.monotonic() - t0, start)
+        return digest.hexdigest()
+
+
+def print_progress(done, total, elapsed, start):
+    rate = (done - start) / elapsed / 1e6 if elapsed > 0 else 0.0
+    left = (total - done) / (rate * 1e6) if rate > 0 else 0.0
+    print("{:7.1f} / {:.1f} MB  {:6.2f} MB/s  {:6.0f} s left".format(done / 1e6, total / 1e6, rate, left),
+          file=sys.stderr)
+
+
+def parse_range(text):
+    address, _, length = text.partition(':')
+    return int(address, 0), int(length, 0)
+
+
+if __name__ == '__main__':
+    import MT25QL01GBBB_20231023 as MT25QL01GBBB
+    from MT25QL01GBBB_regions import region_table
+
+    parser = argparse.ArgumentParser(description='MT25QL01GBBB device imaging')
+    parser.add_argument('image')
+    parser.add_argument('--region', action='append', default=[], help='region name from the region table')
+    parser.add_argument('--range', action='append', default=[], type=parse_range, help='ADDRESS:LENGTH')
+    parser.add_argument('--restart', action='store_true', help='ignore the saved progress')
+    args = parser.parse_args()
+
+    Flash = MT25QL01GBBB.get_flash()
+    regions = list(args.range)
+    if args.region:
+        Regions = region_table(Flash)
+        Regions.load_or_default()
+        regions += [Regions.lookup(name) for name in args.region]
+    regions.sort()
+
+    image = device_image(Flash, args.image, regions)
+    sha256 = image.run(resume=not args.restart, report=print_progress)
+    if regions:
+        # 領域だけのときはファイルの sha256 ではないので、sha256sum の形式にしない
+        print("sha256 of regions {}: {}".format(
+            ', '.join('0x{:08X}+0x{:X}'.format(address, length) for address, length in regions), sha256))
+    else:
+        print("{}  {}".format(sha256, args.image))
@@ -0,0 +1,204 @@
+# MT25QL01GBBB_logstore.py
+# フラッシュ上の追記専用ログ(画像などを順番に書き足していく保存領域)
+#
+# 決まったアドレスに上書きすると毎回 消去→書き込み になるが、
+# ここでは format() で領域全体を先に消去しておき、消去済みの領域に追記だけしていく
+# (保存にかかるのは書き込み時間だけになる)
+#
+# 領域の構成 (start から length バイト、64KBセクタ境界に揃えること)
+#   先頭ページ : スーパーブロック  '>4sIII' = b'MLSB', version, format回数, crc32
+#   以降       : レコードを256バイト境界から順に並べる
+#     ヘッダ '>4sIIIII' = b'MREC', seq, length, tag, データのcrc32, ヘッダのcrc32
+#     その直後に length バイトのデータ
+#   データ→ヘッダの順に書くので、ヘッダが読めるレコードはデータまで書き終わっている
+#
+# 起動時はヘッダだけを順にたどって、メモリ上の索引(seq, アドレス, 長さ, tag)を作る
+# 書きかけのデータ(ヘッダなし)があれば、空いたセクタの先頭まで飛ばして続ける
+
+# -*- coding: utf-8 -*-
+import sys
+import struct
+import binascii
+import bisect
+from array import array
+
+
+SUPERBLOCK = struct.Struct('>4sIII')
+SUPERBLOCK_MAGIC = b'MLSB'
+SUPERBLOCK_VERSION = 1
+RECORD_HEADER = struct.Struct('>4sIIIII')
+RECORD_MAGIC = b'MREC'
+PAGE_SIZE = 256
+
+
+def align_up(value, unit):
+    return value + (-value % unit)
+
+
+class log_store:
+    def __init__(self, flash, start, length):
+        if start % flash.SECTOR_SIZE or length % flash.SECTOR_SIZE:
+            raise ValueError('log store must be 64KB aligned: 0x{:x} + 0x{:x}'.format(start, length))
+        self.flash = flash
+        self.start = start
+        self.length = length
+        self.end = start + length
+        self.data_start = start + PAGE_SIZE
+        self._clear_index()
+        self.format_count = None
+
+    def _clear_index(self):
+        # 索引はレコードごとに4バイト×4の配列で持つ
+        self.seqs = array('I')
+        self.addresses = array('I')
+        self.lengths = array('I')
+        self.tags = array('I')
+        self.next_seq = 0
+        self.write_pointer = self.data_start
+
+    # 領域全体を消去してスーパーブロックを書く(中のレコードはすべて消える)
+    def format(self):
+        count = 0 if self.format_count is None else self.format_count + 1
+        self.flash.erase_range(self.start, self.length)
+        body = SUPERBLOCK_MAGIC + struct.pack('>II', SUPERBLOCK_VERSION, count)
+        self.flash.write_page(self.start, SUPERBLOCK.pack(SUPERBLOCK_MAGIC, SUPERBLOCK_VERSION, count,
+                                                          binascii.crc32(body)))
+        self.format_count = count
+        self._clear_index()
+
+    # ヘッダをたどって索引を作り直す。format されていない領域なら False
+    def mount(self):
+        self._clear_index()
+        magic, version, count, crc = SUPERBLOCK.unpack(self.flash.read_bytes(self.start, SUPERBLOCK.size))
+        body = magic + struct.pack('>II', version, count)
+        if magic != SUPERBLOCK_MAGIC or binascii.crc32(body) != crc:
+            self.format_count = None
+            return False
+        self.format_count = count
+        header = bytearray(RECORD_HEADER.size)
+        address = self.data_start
+        while address + RECORD_HEADER.size <= self.end:
+            self.flash.read_into(address, header)
+            record = self._parse_header(header)
+            if record is None:
+                # 空いていればここが終わり。書きかけ(ヘッダを書く前に止まった)のデータが残っていたら
+                # そのセクタは使わず、次のセクタから続きを探す(データが次のセクタまで続いていることもある)
+                sector_end = min(align_up(address + 1, self.flash.SECTOR_SIZE), self.end)
+                if self.flash.is_blank(address, sector_end - address):
+                    break
+                address = sector_end
+                continue
+            seq, length, tag = record
+            self.seqs.append(seq)
+            self.addresses.append(address)
+            self.lengths.append(length)
+            self.tags.append(tag)
+            self.next_seq = seq + 1
+            address = align_up(address + RECORD_HEADER.size + length, PAGE_SIZE)
+        self.write_pointer = min(address, self.end)
+        return True
+
+    def _parse_header(self, header):
+        magic, seq, length, tag, data_crc, header_crc = RECORD_HEADER.unpack(header)
+        if magic != RECORD_MAGIC or binascii.crc32(header[:RECORD_HEADER.size - 4]) != header_crc:
+            return None
+        return seq, length, tag
+
+    # 追記できる残りバイト数(ヘッダ分を除く)
+    def free_space(self):
+        return max(self.end - self.write_pointer - RECORD_HEADER.size, 0)
+
+    # data を追記して seq を返す。tag は用途の番号(写真の種類など)
+    def append(self, data, tag=0):
+        if self.format_count is None:
+            raise RuntimeError('log store is not formatted (call format() or mount())')
+        view = memoryview(data).cast('B')
+        length = len(view)
+        address = self.write_pointer
+        if address + RECORD_HEADER.size + length > self.end:
+            raise ValueError('log store full: need {} bytes, {} free'.format(length, self.free_space()))
+        # 消去されていない所に書くと前のデータと混ざるので書かない
+        if not self.flash.is_blank(address, RECORD_HEADER.size + length):
+            raise IOError('log store at 0x{:x} is not erased (format() to reuse the area)'.format(address))
+        seq = self.next_seq
+        header = bytearray(RECORD_HEADER.size)
+        RECORD_HEADER.pack_into(header, 0, RECORD_MAGIC, seq, length, tag, binascii.crc32(view), 0)
+        struct.pack_into('>I', header, RECORD_HEADER.size - 4, binascii.crc32(header[:RECORD_HEADER.size - 4]))
+        self.flash.write_bytes(address + RECORD_HEADER.size, view)
+        self.flash.write_bytes(address, header)
+        self.seqs.append(seq)
+        self.addresses.append(address)
+        self.lengths.append(length)
+        self.tags.append(tag)
+        self.next_seq = seq + 1
+        self.write_pointer = align_up(address + RECORD_HEADER.size + length, PAGE_SIZE)
+        return seq
+
+    def __len__(self):
+        return len(self.seqs)
+
+    # 索引の位置を seq から二分探索で求める
+    def _index(self, seq):
+        i = bisect.bisect_left(self.seqs, seq)
+        if i == len(self.seqs) or self.seqs[i] != seq:
+            raise KeyError(seq)
+        return i
+
+    # レコードの (seq, アドレス, 長さ, tag) を順に返す
+    def records(self, tag=None):
+        for i in range(len(self.seqs)):
+            if tag is None or self.tags[i] == tag:
+                yield self.seqs[i], self.addresses[i], self.lengths[i], self.tags[i]
+
+    # レコードのデータを読む。verify=True ならcrc32を確かめる
+    def read(self, seq, verify=True):
+        i = self._index(seq)
+        address = self.addresses[i]
+        header = self.flash.read_bytes(address, RECORD_HEADER.size)
+        data = self.flash.read_bytes(address + RECORD_HEADER.size, self.lengths[i])
+        if verify and binascii.crc32(data) != RECORD_HEADER.unpack(header)[4]:
+            raise IOError('log record {} at 0x{:x}: data crc mismatch'.format(seq, address))
+        return data
+
+
+if __name__ == '__main__':
+    import MT25QL01GBBB_20231023 as MT25QL01GBBB
+    from MT25QL01GBBB_regions import region_table
+
+    # 領域表の LOG_STORE (表になければ CHIBANY_PHOTO_COPY 以降の 1MB)
+    LOG_START = 0x00010000
+    LOG_LENGTH = 0x00100000
+
+    Flash = MT25QL01GBBB.get_flash()
+    Regions = region_table(Flash)
+    Regions.load_or_default()
+    if 'LOG_STORE' in Regions:
+        LOG_START, LOG_LENGTH = Regions.lookup('LOG_STORE')
+    store = log_store(Flash, LOG_START, LOG_LENGTH)
+    if not store.mount():
+        print("log store is not formatted (f: format)")
+
+    try:
+        while True:
+            keydata = input("input command (l: list, a: append file, r: read record, f: format)\n")
+            if keydata == 'l':
+                for seq, address, length, tag in store.records():
+                    print(f"seq {seq:5d}  0x{address:08X}  {length:8d} bytes  tag {tag}")
+                print(f"{len(store)} records, {store.free_space()} bytes free")
+            elif keydata == 'a':
+                path = input("file to append\n")
+                with open(path, 'rb') as f:
+                    seq = store.append(f.read())
+                print(f"appended as seq {seq}")
+            elif keydata == 'r':
+                seq = int(input("seq\n"))
+                path = input("output file\n")
+                with open(path, 'wb') as f:
+                    f.write(store.read(seq))
+            elif keydata == 'f':
+                store.format()
+                print("formatted")
+    except (KeyboardInterrupt, EOFError):
+        pass
+    except Exception as e:
+        print(f"error: {e}", file=sys.stderr)
@@ -0,0 +1,278 @@
+# MT25QL01GBBB_regions.py
+# フラッシュ上の名前付き領域表(ミッションのアドレス定数をまとめたもの)
+#
+# 各ツールがそれぞれアドレス定数とショートカットキーを持っていたのを、
+# フラッシュ上の表(4KB 1つ)にまとめ、名前やキーで引けるようにする
+#
+# 表の構成 (REGION_TABLE_ADDRESS の4KBサブセクタ)
+#   ヘッダ '>4sHHI' = b'MRGT', version, 件数, エントリ部のcrc32
+#   エントリ '>23scII' = 名前(23バイト, 0埋め), ショートカットキー(1文字, なければ空白), アドレス, 長さ
+# メモリ上では名前順に並べておき、二分探索で引く
+# allocate_least_worn は flash の消去回数を見て、あまり消去されていないセクタに領域を取る
+#
+# 使い方 (表を書くまでは各ツールが DEFAULT_REGIONS を使う):
+#   python3 MT25QL01GBBB_regions.py list                   # 表(なければ既定)を表示
+#   python3 MT25QL01GBBB_regions.py init                   # DEFAULT_REGIONS をフラッシュに書く
+#   python3 MT25QL01GBBB_regions.py add NAME 0x07400000 0x10000 --key z
+#   python3 MT25QL01GBBB_regions.py allocate NAME 0x100000 --least-worn
+#   python3 MT25QL01GBBB_regions.py remove NAME
+
+# -*- coding: utf-8 -*-
+import sys
+import struct
+import binascii
+import bisect
+import argparse
+
+
+REGION_TABLE_ADDRESS = 0x07FFF000
+TABLE_HEADER = struct.Struct('>4sHHI')
+TABLE_MAGIC = b'MRGT'
+TABLE_VERSION = 1
+TABLE_ENTRY = struct.Struct('>23scII')
+TABLE_SIZE = 0x1000
+MAX_ENTRIES = (TABLE_SIZE - TABLE_HEADER.size) // TABLE_ENTRY.size
+
+# allocate で新しい領域を取る範囲
+# 最後の2MBは取らない: 0x07E00000 からの1MBは性能測定(MT25QL01GBBB_benchmark.py)が、
+# 0x07FFE000 の4KBはクロック調整(calibrate_clock)が消去して使い、0x07FFF000 はこの表
+ALLOC_START = 0x00010000
+ALLOC_END = 0x07E00000
+
+# 表がまだ書かれていないときに使う既定の領域 (名前, キー, アドレス, 長さ)
+# 元のツールにはアドレスしかなかったので、長さは次の領域までの間隔
+# (PUMICE_MSN_DATA だけは次がないので、ほかの MSN_DATA と同じ長さにしてある。init の前に確かめること)
+# LOG_STORE は MT25QL01GBBB_logstore.py の領域 (allocate がここを返さないように登録しておく)
+DEFAULT_REGIONS = (
+    ('CHIBANY_PHOTO_COPY_SIZE', '0', 0x00000000, 0x1000),
+    ('CHIBANY_PHOTO_COPY', '1', 0x00001000, 0x2000),
+    ('CHIBANY_PHOTO_COPY_2', '2', 0x00003000, 0xD000),
+    ('LOG_STORE', '', 0x00010000, 0x100000),
+    ('CORN_MSN_TMBHEAD_DATA', 'a', 0x05B60000, 0x1000),
+    ('CORN_MSN_TMB_DATA', 'b', 0x05B61000, 0x7DF000),
+    ('AURORA_MSN_TMBHEAD_DATA', 'k', 0x06340000, 0x1000),
+    ('AURORA_MSN_TMB_DATA', 'l', 0x06341000, 0x358000),
+    ('PUMICE_MSN_TMBHEAD_DATA', 'm', 0x06699000, 0x1000),
+    ('PUMICE_MSN_TMB_DATA', 'n', 0x0669A000, 0x358000),
+    ('CORN_MSN_HEAD_DATA', 'e', 0x069F2000, 0x1000),
+    ('CORN_MSN_DATA', 'f', 0x069F3000, 0x320000),
+    ('AURORA_MSN_HEAD_DATA', 's', 0x06D13000, 0x1000),
+    ('AURORA_MSN_DATA', 't', 0x06D14000, 0x320000),
+    ('PUMICE_MSN_HEAD_DATA', 'x', 0x07034000, 0x1000),
+    ('PUMICE_MSN_DATA', 'y', 0x07035000, 0x320000),
+)
+
+
+class region_table:
+    def __init__(self, flash, address=REGION_TABLE_ADDRESS):
+        self.flash = flash
+        self.address = address
+        self._names = []
+        self._entries = []  # (key, address, length) を _names と同じ順で持つ
+        self._keys = {}     # ショートカットキー → 名前
+
+    # 既定の領域で表を作り直す(フラッシュには書かない)
+    def set_default(self):
+        self._names = []
+        self._entries = []
+        self._keys = {}
+        for name, key, address, length in DEFAULT_REGIONS:
+            self.add(name, address, length, key)
+
+    # フラッシュから表を1回で読み込む。表がなければ False
+    def load(self):
+        raw = self.flash.read_bytes(self.address, TABLE_SIZE)
+        magic, version, count, crc = TABLE_HEADER.unpack_from(raw)
+        body = raw[TABLE_HEADER.size:TABLE_HEADER.size + count * TABLE_ENTRY.size]
+        if magic != TABLE_MAGIC or count > MAX_ENTRIES or binascii.crc32(body) != crc:
+            return False
+        self._names = []
+        self._entries = []
+        self._keys = {}
+        for name, key, address, length in TABLE_ENTRY.iter_unpack(body):
+            self.add(name.rstrip(b'\x00').decode(), address, length, key.decode().strip())
+        return True
+
+    # フラッシュの表を読み、なければ既定の領域を使う
+    def load_or_default(self):
+        if not self.load():
+            self.set_default()
+
+    # 表をフラッシュに書く(変わったページだけ書き込む)
+    # 重なっている領域があれば書かずに ValueError
+    def save(self):
+        overlaps = self.overlaps()
+        if overlaps:
+            raise ValueError('overlapping regions: {}'.format(
+                ', '.join('{} / {}'.format(a, b) for a, b in overlaps)))
+        body = bytearray()
+        for name, (key, address, length) in zip(self._names, self._entries):
+            body += TABLE_ENTRY.pack(name.encode(), (key or ' ').encode(), address, length)
+        raw = TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(self._names), binascii.crc32(body)) + body
+        self.flash.update_bytes(self.address, raw)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        i = bisect.bisect_left(self._names, name)
+        return i < len(self._names) and self._names[i] == name
+
+    # 重なっている領域の名前の組 (アドレス順)
+    def overlaps(self):
+        result = []
+        last = None     # それまでで最も後ろまで届く領域 (名前, 終わりのアドレス)
+        for name, _, address, length in self.regions():
+            if last is not None and address < last[1]:
+                result.append((last[0], name))
+            if last is None or address + length > last[1]:
+                last = (name, address + length)
+        return result
+
+    # 名前から (アドレス, 長さ) を引く
+    def lookup(self, name):
+        i = bisect.bisect_left(self._names, name)
+        if i == len(self._names) or self._names[i] != name:
+            raise KeyError(name)
+        return self._entries[i][1:]
+
+    # ショートカットキー・名前・16進アドレスのどれかからアドレスを求める
+    def resolve(self, keydata):
+        if keydata in self._keys:
+            return self.lookup(self._keys[keydata])[0]
+        if keydata in self:
+            return self.lookup(keydata)[0]
+        return int(keydata, 16)
+
+    # (名前, キー, アドレス, 長さ) をアドレス順に返す
+    def regions(self):
+        items = [(name,) + entry for name, entry in zip(self._names, self._entries)]
+        return sorted(items, key=lambda item: item[2])
+
+    def add(self, name, address, length, key=''):
+        if len(name.encode()) > 23:
+            raise ValueError('region name too long: {}'.format(name))
+        if name in self:
+            raise KeyError('region already exists: {}'.format(name))
+        if len(self._names) >= MAX_ENTRIES:
+            raise ValueError('region table full ({} entries)'.format(MAX_ENTRIES))
+        i = bisect.bisect_left(self._names, name)
+        self._names.insert(i, name)
+        self._entries.insert(i, (key, address, length))
+        if key:
+            self._keys[key] = name
+
+    def remove(self, name):
+        i = bisect.bisect_left(self._names, name)
+        if i == len(self._names) or self._names[i] != name:
+            raise KeyError(name)
+        self._keys.pop(self._entries[i][0], None)
+        del self._names[i]
+        del self._entries[i]
+
+    # 空いている場所(既存の領域と重ならない所)に length バイトの領域を取って登録する
+    # align 境界に揃える(既定は4KB)。戻り値はアドレス
+    def allocate(self, name, length, align=0x1000, key='', start=ALLOC_START, end=ALLOC_END):
+        address = start + (-start % align)
+        for _, _, used, used_length in self.regions():
+            if used + used_length <= address:
+                continue
+            if used >= address + length:
+                break
+            address = used + used_length
+            address += -address % align
+        if address + length > end:
+            raise ValueError('no free extent of 0x{:x} bytes'.format(length))
+        self.add(name, address, length, key)
+        return address
+
+    # 消去回数の少ない空きセクタに領域を取って登録する(64KB単位、flash.erase_counts を使う)
+    # 既存の領域と重ならない連続したセクタの並びのうち、消去回数の合計が最も少ないところを選ぶ
+    # (同じなら前の方)。戻り値はアドレス
+    def allocate_least_worn(self, name, length, key='', start=ALLOC_START, end=ALLOC_END):
+        sector = self.flash.SECTOR_SIZE
+        counts = self.flash.erase_counts
+        need = max(-(-length // sector), 1)
+        first = -(-start // sector)
+        last = end // sector
+        free = bytearray(b'\x01') * max(last - first, 0)
+        for _, _, used, used_length in self.regions():
+            lo = max(used // sector, first)
+            hi = min(-(-(used + used_length) // sector), last)
+            if hi > lo:
+                free[lo - first:hi - first] = bytes(hi - lo)
+        best = None
+        run = total = 0
+        for i in range(first, last):
+            if not free[i - first]:
+                run = total = 0
+                continue
+            run += 1
+            total += counts[i]
+            if run > need:
+                total -= counts[i - need]
+                run = need
+            if run == need and (best is None or total < best[0]):
+                best = (total, i - need + 1)
+        if best is None:
+            raise ValueError('no free run of {} sectors'.format(need))
+        address = best[1] * sector
+        self.add(name, address, length, key)
+        return address
+
+
+if __name__ == '__main__':
+    import MT25QL01GBBB_20231023 as MT25QL01GBBB
+
+    number = lambda text: int(text, 0)
+    parser = argparse.ArgumentParser(description='MT25QL01GBBB region table')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='print the table (DEFAULT_REGIONS if none is written)')
+    init = commands.add_parser('init', help='write DEFAULT_REGIONS to flash')
+    init.add_argument('--force', action='store_true', help='overwrite an existing table')
+    add = commands.add_parser('add', help='add a region at a fixed address')
+    add.add_argument('name')
+    add.add_argument('address', type=number)
+    add.add_argument('length', type=number)
+    add.add_argument('--key', default='')
+    allocate = commands.add_parser('allocate', help='add a region in free space')
+    allocate.add_argument('name')
+    allocate.add_argument('length', type=number)
+    allocate.add_argument('--key', default='')
+    allocate.add_argument('--least-worn', action='store_true', help='pick the least erased 64KB sectors')
+    remove = commands.add_parser('remove', help='remove a region')
+    remove.add_argument('name')
+    args = parser.parse_args()
+
+    Flash = MT25QL01GBBB.get_flash()
+    Regions = region_table(Flash)
+    loaded = Regions.load()
+    if args.command == 'init':
+        if loaded and not args.force:
+            print("a region table is already written at 0x{:08X} (--force to overwrite)".format(Regions.address),
+                  file=sys.stderr)
+            sys.exit(1)
+        Regions.set_default()
+        Regions.save()
+        print("written {} regions".format(len(Regions)))
+    elif args.command in ('add', 'allocate', 'remove'):
+        if not loaded:
+            print("no region table on flash (run init first)", file=sys.stderr)
+            sys.exit(1)
+        if args.command == 'add':
+            Regions.add(args.name, args.address, args.length, args.key)
+        elif args.command == 'allocate' and args.least_worn:
+            Regions.allocate_least_worn(args.name, args.length, args.key)
+        elif args.command == 'allocate':
+            Regions.allocate(args.name, args.length, key=args.key)
+        else:
+            Regions.remove(args.name)
+        Regions.save()
+    elif not loaded:
+        Regions.set_default()
+        print("no region table on flash, showing DEFAULT_REGIONS")
+    for name, key, address, length in Regions.regions():
+        print("{:23s} {:1s}  0x{:08X} - 0x{:08X}  {:8d} KB".format(
+            name, key or '', address, address + length - 1, length // 1024))
+    for a, b in Regions.overlaps():
+        print("warning: {} overlaps {}".format(a, b), file=sys.stderr)
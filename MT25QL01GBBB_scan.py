@@ -0,0 +1,198 @@
+# MT25QL01GBBB_scan.py
+# フラッシュ全体(128MB)の占有マップ
+#
+# 大きなチャンクで順に読み、4KBサブセクタごとに次のどれかに分ける
+#   erased : すべて 0xFF
+#   partial: 書き込みがあるが、最後のページ(256バイト)がまだ 0xFF (途中まで書いたもの)
+#   full   : それ以外
+# チャンク全体・サブセクタ・ページの比較はすべてバイト列の一括比較で行う(1バイトずつ見ない)
+#
+# 2回目以降の scan() は、前のスキャンから書き込み・消去した所(flash.changed)だけ調べ直す
+# flash.changed はファイルに保存されるので、保存したマップを別のプロセスで読み込んでも差分で済む
+# scan() の最初に flash.save_erase_counts() で、他のプロセスが保存した記録を取り込む
+# 注意: 他のプロセスがまだ保存していない書き込み・消去は見えない。書き込むプロセスが動いている間の
+#       差分スキャンは安全ではない(止めてから行うか、full=True で)
+#       記録を保存する前に止まったプロセスや、このドライバを通さない書き込みも見えないので、そのときも full=True で
+#
+# 使い方:
+#   python3 MT25QL01GBBB_scan.py                       # 全体をスキャンしてまとめを表示
+#   python3 MT25QL01GBBB_scan.py --map occupancy.bin   # 前回のマップがあれば差分だけスキャンして保存
+
+# -*- coding: utf-8 -*-
+import os
+import struct
+import argparse
+
+
+ERASED = 0
+PARTIAL = 1
+FULL = 2
+STATE_NAMES = ('erased', 'partial', 'full')
+
+SUBSECTOR_SIZE = 0x1000
+PAGE_SIZE = 256
+SCAN_CHUNK = 0x40000
+
+# 保存形式: ヘッダ '>4sHIII' = b'MOCC', version, 開始アドレス, サブセクタ数, スキャンしたときの flash.change_counter
+#           続けてサブセクタごとの状態(1バイト)
+MAP_HEADER = struct.Struct('>4sHIII')
+MAP_MAGIC = b'MOCC'
+MAP_VERSION = 1
+
+
+class occupancy_map:
+    def __init__(self, flash, start=0, length=None, chunk_size=SCAN_CHUNK):
+        if length is None:
+            length = flash.FLASH_SIZE - start
+        if start % flash.SECTOR_SIZE or length % flash.SECTOR_SIZE:
+            raise ValueError('scan range must be 64KB aligned: 0x{:x} + 0x{:x}'.format(start, length))
+        self.flash = flash
+        self.start = start
+        self.length = length
+        self.chunk_size = chunk_size - chunk_size % SUBSECTOR_SIZE
+        self.states = bytearray(length // SUBSECTOR_SIZE)
+        self.generation = None  # スキャンしたときの flash.change_counter (まだなら None)
+        self._blank = b'\xff' * self.chunk_size
+
+    # チャンク(4KBの倍数)を分類して states に入れる
+    def _classify(self, index, view):
+        n = len(view)
+        if view == self._blank[:n]:
+            self.states[index:index + n // SUBSECTOR_SIZE] = bytes(n // SUBSECTOR_SIZE)
+            return
+        blank = self._blank[:SUBSECTOR_SIZE]
+        blank_page = blank[:PAGE_SIZE]
+        for offset in range(0, n, SUBSECTOR_SIZE):
+            sub = view[offset:offset + SUBSECTOR_SIZE]
+            if sub == blank:
+                state = ERASED
+            elif sub[-PAGE_SIZE:] == blank_page:
+                state = PARTIAL
+            else:
+                state = FULL
+            self.states[index + offset // SUBSECTOR_SIZE] = state
+
+    # 調べ直すサブセクタの番号(states の添字)を返す
+    def _targets(self, full):
+        count = len(self.states)
+        if full or self.generation is None or self.generation > self.flash.change_counter:
+            return range(count)
+        base = self.start // SUBSECTOR_SIZE
+        changed = self.flash.changed
+        generation = self.generation
+        return [i for i in range(count) if changed[base + i] > generation]
+
+    # スキャンして、調べたサブセクタ数を返す
+    # full=True なら差分ではなく全体を調べる
+    def scan(self, full=False):
+        self.flash.save_erase_counts()
+        targets = self._targets(full)
+        generation = self.flash.change_counter
+        buf = bytearray(self.chunk_size)
+        checked = 0
+        # 続いているサブセクタはまとめて chunk_size ずつ読む
+        i = 0
+        while i < len(targets):
+            j = i
+            while j + 1 < len(targets) and targets[j + 1] == targets[j] + 1:
+                j += 1
+            first = targets[i]
+            address = self.start + first * SUBSECTOR_SIZE
+            length = (targets[j] - first + 1) * SUBSECTOR_SIZE
+            index = first
+            for chunk in self.flash.read_chunks(address, length, buf=buf):
+                self._classify(index, chunk)
+                index += len(chunk) // SUBSECTOR_SIZE
+            checked += length // SUBSECTOR_SIZE
+            i = j + 1
+        self.generation = generation
+        return checked
+
+    # 状態ごとのサブセクタ数
+    def summary(self):
+        return {name: self.states.count(state) for state, name in enumerate(STATE_NAMES)}
+
+    # 同じ状態が続く範囲を (状態名, アドレス, 長さ) で返す
+    def runs(self):
+        result = []
+        states = self.states
+        i = 0
+        while i < len(states):
+            state = states[i]
+            j = i + 1
+            while j < len(states) and states[j] == state:
+                j += 1
+            result.append((STATE_NAMES[state], self.start + i * SUBSECTOR_SIZE, (j - i) * SUBSECTOR_SIZE))
+            i = j
+        return result
+
+    # 使用中(erased 以外)のサブセクタを1ビットで表したビットマップ (先頭のサブセクタが最初のバイトの最上位ビット)
+    # 128MB なら 4KB
+    def bitmap(self):
+        used = bytes(1 if state != ERASED else 0 for state in self.states)
+        bits = bytearray((len(used) + 7) // 8)
+        for i in range(0, len(used), 8):
+            byte = 0
+            for bit in used[i:i + 8]:
+                byte = byte << 1 | bit
+            bits[i // 8] = byte << (8 - len(used[i:i + 8]))
+        return bytes(bits)
+
+    def save(self, path):
+        if self.generation is None:
+            raise RuntimeError('occupancy map has not been scanned')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, self.start, len(self.states), self.generation))
+            f.write(self.states)
+        os.replace(tmp, path)
+
+    # 保存したマップを読む。なければ・範囲が違えば False
+    def load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return False
+        if len(raw) < MAP_HEADER.size:
+            return False
+        magic, version, start, count, generation = MAP_HEADER.unpack_from(raw)
+        if magic != MAP_MAGIC or version != MAP_VERSION or start != self.start \
+                or count != len(self.states) or len(raw) != MAP_HEADER.size + count:
+            return False
+        self.states[:] = raw[MAP_HEADER.size:]
+        self.generation = generation
+        return True
+
+
+if __name__ == '__main__':
+    import time
+    import MT25QL01GBBB_20231023 as MT25QL01GBBB
+
+    parser = argparse.ArgumentParser(description='MT25QL01GBBB occupancy map')
+    parser.add_argument('--map', default=None, help='map file (load, rescan changes, save)')
+    parser.add_argument('--full', action='store_true', help='rescan everything')
+    parser.add_argument('--bitmap', default=None, help='write the used-subsector bitmap to this file')
+    parser.add_argument('--runs', action='store_true', help='print every run')
+    args = parser.parse_args()
+
+    Flash = MT25QL01GBBB.get_flash()
+    occupancy = occupancy_map(Flash)
+    if args.map and occupancy.load(args.map):
+        print("loaded {}".format(args.map))
+    t0 = time.monotonic()
+    checked = occupancy.scan(full=args.full)
+    elapsed = time.monotonic() - t0
+    mb = checked * SUBSECTOR_SIZE / 1e6
+    print("scanned {} subsectors ({:.1f} MB) in {:.2f} s ({:.2f} MB/s)".format(
+        checked, mb, elapsed, mb / elapsed if elapsed > 0 else 0.0))
+    for name, count in occupancy.summary().items():
+        print("{:8s} {:6d} subsectors".format(name, count))
+    for name, address, length in occupancy.runs():
+        if args.runs or name != 'erased':
+            print("0x{:08X} - 0x{:08X}  {:8s} {:6d} KB".format(address, address + length - 1, name, length // 1024))
+    if args.bitmap:
+        with open(args.bitmap, 'wb') as f:
+            f.write(occupancy.bitmap())
+    if args.map:
+        occupancy.save(args.map)
@@ -0,0 +1,304 @@
+# MT25QL01GBBB_scheduler.py
+# 1つのフラッシュを複数のスレッド(撮影、HK監視、ダンプなど)で共有するためのI/Oスケジューラ
+#
+# 読み込み・書き込み・消去を別々のキューに入れ、読み込みを優先して実行する
+#  - 消去は専用スレッドで行い、消去中の読み込みは消去を一時停止して割り込む(read_urgent_into)
+#  - 消去は plan_erase の単位(最大64KB)ごとに行い、その合間に待っている書き込みを通す
+#    (大きな消去をまとめても、書き込みは1単位分しか待たされない)
+#  - 隣り合う(読み込みは重なる)要求は1回にまとめる
+#  - 優先度の低い要求も MAX_WAIT を超えて待たされたら先に実行する
+#  - ただし範囲が重なる要求どうしは(読み込みどうしを除き)投げた順に実行する
+#    (消去→書き込み→読み込み と投げたら、書き込みは消去の後、読み込みは書き込みの後)
+#  - クラスごとのキューの深さと待ち時間・所要時間を stats() で返す
+#
+# 使い方:
+#   sched = flash_scheduler(Flash)
+#   data = sched.read(address, 256).result()
+#   sched.program(address, jpeg_bytes)      # 消去済みの領域に書き込む
+#   sched.erase(address, 0x10000)
+#   sched.close()
+
+# -*- coding: utf-8 -*-
+import time
+import threading
+from concurrent.futures import Future
+
+from MT25QL01GBBB_20231023 import transfer_stats
+
+
+READ = 0
+PROGRAM = 1
+ERASE = 2
+CLASS_NAMES = ('read', 'program', 'erase')
+
+# クラスごとの最大待ち時間 [s] (これを超えた要求は優先度に関係なく先に実行する)
+MAX_WAIT = (0.02, 0.5, 2.0)
+# まとめる要求の最大サイズ [byte]
+MAX_MERGE = (0x100000, 0x100000, 0x1000000)
+
+
+class _request:
+    __slots__ = ('cls', 'seq', 'address', 'end', 'data', 'future', 'submitted', 'started')
+
+    def __init__(self, cls, address, length, data=None):
+        self.cls = cls
+        self.seq = 0
+        self.address = address
+        self.end = address + length
+        self.data = data
+        self.future = Future()
+        self.submitted = time.monotonic()
+        self.started = None
+
+
+class _class_stats:
+    __slots__ = ('count', 'merged', 'max_depth', 'wait_total', 'wait_max', 'latency_total', 'latency_max')
+
+    def __init__(self):
+        self.count = self.merged = self.max_depth = 0
+        self.wait_total = self.wait_max = self.latency_total = self.latency_max = 0.0
+
+
+class flash_scheduler:
+    def __init__(self, flash):
+        self.flash = flash
+        self._queues = ([], [], [])
+        self._stats = [_class_stats() for _ in CLASS_NAMES]
+        self._cond = threading.Condition()
+        self._erase_jobs = None      # 消去スレッドに渡した要求
+        self._erase_busy = False     # 消去の1単位を実行中 (この間は書き込みを始めない)
+        self._programming = False    # 書き込みを実行中 (この間は次の消去の単位を始めない)
+        self._next_seq = 0           # 投げた順の通し番号
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name='flash_scheduler', daemon=True)
+        self._eraser = threading.Thread(target=self._erase_worker, name='flash_scheduler_erase', daemon=True)
+        self._dispatcher.start()
+        self._eraser.start()
+
+    # 読み込み要求。Future の結果は bytearray
+    def read(self, address, length):
+        return self._submit(_request(READ, address, length))
+
+    # 書き込み要求(消去済みの領域に write_bytes)。Future の結果は transfer_stats
+    def program(self, address, data):
+        data = memoryview(data).cast('B')
+        return self._submit(_request(PROGRAM, address, len(data), data))
+
+    # 消去要求(4KB境界)。Future の結果は transfer_stats
+    def erase(self, address, length):
+        return self._submit(_request(ERASE, address, length))
+
+    def _submit(self, req):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('flash_scheduler is closed')
+            queue = self._queues[req.cls]
+            req.seq = self._next_seq
+            self._next_seq += 1
+            queue.append(req)
+            stats = self._stats[req.cls]
+            stats.max_depth = max(stats.max_depth, len(queue))
+            self._cond.notify_all()
+        return req.future
+
+    # クラスごとの統計 (現在のキューの深さ, 処理数, まとめた数, 待ち時間と所要時間の平均/最大[s])
+    def stats(self):
+        with self._cond:
+            result = {}
+            for cls, name in enumerate(CLASS_NAMES):
+                s = self._stats[cls]
+                result[name] = {
+                    'depth': len(self._queues[cls]),
+                    'max_depth': s.max_depth,
+                    'count': s.count,
+                    'merged': s.merged,
+                    'wait_avg': s.wait_total / s.count if s.count else 0.0,
+                    'wait_max': s.wait_max,
+                    'latency_avg': s.latency_total / s.count if s.count else 0.0,
+                    'latency_max': s.latency_max,
+                }
+            return result
+
+    # 残りの要求を実行してからスレッドを止める
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._dispatcher.join()
+        self._eraser.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # req より前に投げられた、範囲の重なる別のクラスの要求が残っていれば True (_cond を持って呼ぶ)
+    # (読み込みどうしは順番を入れ替えてよい)
+    def _blocked(self, req):
+        for cls, queue in enumerate(self._queues):
+            if cls == req.cls or (cls == READ and req.cls == READ):
+                continue
+            for other in queue:
+                if other.seq < req.seq and other.address < req.end and req.address < other.end:
+                    return True
+        if self._erase_jobs is not None:
+            for other in self._erase_jobs[0]:
+                if other.address < req.end and req.address < other.end:
+                    return True
+        return False
+
+    # クラスの中で最初の、待たなくてよい要求
+    def _first_ready(self, cls):
+        for req in self._queues[cls]:
+            if not self._blocked(req):
+                return req
+        return None
+
+    # 次に実行する要求を選ぶ(_cond を持った状態で呼ぶ)
+    # 消去の単位の実行中は読み込みだけ、単位の合間は書き込みも実行できる
+    # MAX_WAIT を超えたものがあれば、超過の大きいものを先に
+    def _pick(self):
+        now = time.monotonic()
+        ready = []
+        for cls in (READ, PROGRAM, ERASE):
+            allowed = cls == READ or self._erase_jobs is None or (cls == PROGRAM and not self._erase_busy)
+            if self._queues[cls] and allowed:
+                req = self._first_ready(cls)
+                if req is not None:
+                    ready.append(req)
+        if not ready:
+            return None
+        overdue = [(now - req.submitted - MAX_WAIT[req.cls], req.seq, req) for req in ready]
+        overdue = [item for item in overdue if item[0] > 0]
+        if overdue:
+            return max(overdue, key=lambda item: item[0])[2]
+        return ready[0]
+
+    # 選んだ要求と、それに隣り合う(読み込みなら重なる)要求をまとめて取り出す
+    # 他の要求を待つべきものはまとめない
+    def _pop_merged(self, first):
+        cls = first.cls
+        queue = self._queues[cls]
+        queue.remove(first)
+        jobs = [first]
+        start, end = jobs[0].address, jobs[0].end
+        merged = True
+        while merged:
+            merged = False
+            for req in queue:
+                if cls == READ:
+                    touches = req.address <= end and req.end >= start
+                else:
+                    touches = req.address == end or req.end == start
+                if touches and max(end, req.end) - min(start, req.address) <= MAX_MERGE[cls] \
+                        and not self._blocked(req):
+                    queue.remove(req)
+                    jobs.append(req)
+                    start, end = min(start, req.address), max(end, req.end)
+                    merged = True
+                    break
+        now = time.monotonic()
+        for req in jobs:
+            req.started = now
+        return jobs, start, end
+
+    def _finish(self, jobs, results=None, error=None):
+        now = time.monotonic()
+        with self._cond:
+            stats = self._stats[jobs[0].cls]
+            stats.merged += len(jobs) - 1
+            for req in jobs:
+                wait = req.started - req.submitted
+                latency = now - req.submitted
+                stats.count += 1
+                stats.wait_total += wait
+                stats.wait_max = max(stats.wait_max, wait)
+                stats.latency_total += latency
+                stats.latency_max = max(stats.latency_max, latency)
+        for i, req in enumerate(jobs):
+            if error is not None:
+                req.future.set_exception(error)
+            else:
+                req.future.set_result(results[i] if isinstance(results, list) else results)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                first = self._pick()
+                while first is None:
+                    if self._closed and not any(self._queues) and self._erase_jobs is None:
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait(0.05)
+                    first = self._pick()
+                cls = first.cls
+                jobs, start, end = self._pop_merged(first)
+                if cls == ERASE:
+                    self._erase_jobs = (jobs, start, end)
+                    self._cond.notify_all()
+                    continue
+                erasing = self._erase_jobs is not None
+                if cls == PROGRAM:
+                    self._programming = True
+            try:
+                if cls == READ:
+                    buf = bytearray(end - start)
+                    if erasing:
+                        self.flash.read_urgent_into(start, buf)
+                    else:
+                        self.flash.read_into(start, buf)
+                    view = memoryview(buf)
+                    results = [bytearray(view[req.address - start:req.end - start]) for req in jobs]
+                else:
+                    jobs.sort(key=lambda req: req.address)
+                    data = b''.join(req.data for req in jobs)
+                    results = self.flash.write_bytes(start, data)
+            except Exception as e:
+                self._finish(jobs, error=e)
+            else:
+                self._finish(jobs, results)
+            if cls == PROGRAM:
+                with self._cond:
+                    self._programming = False
+                    self._cond.notify_all()
+
+    def _erase_worker(self):
+        while True:
+            with self._cond:
+                while self._erase_jobs is None:
+                    if self._closed and not self._queues[ERASE] and not self._dispatcher.is_alive():
+                        return
+                    self._cond.wait(0.05)
+                jobs, start, end = self._erase_jobs
+            try:
+                t0 = time.monotonic()
+                for _, address, size in self.flash.plan_erase(start, end - start):
+                    self._erase_gap()
+                    try:
+                        self.flash.erase_range(address, size)
+                    finally:
+                        with self._cond:
+                            self._erase_busy = False
+                            self._cond.notify_all()
+                elapsed = time.monotonic() - t0
+                result = transfer_stats(end - start, elapsed, (end - start) / elapsed if elapsed > 0 else 0.0)
+            except Exception as e:
+                self._finish(jobs, error=e)
+            else:
+                self._finish(jobs, result)
+            with self._cond:
+                self._erase_jobs = None
+                self._cond.notify_all()
+
+    # 消去の次の単位を始める前に、待っている書き込みを通す
+    # (実行中の書き込みは終わるまで待つ。書き込みが続いても消去が止まらないよう、次を待つのは MAX_WAIT[PROGRAM] まで)
+    def _erase_gap(self):
+        with self._cond:
+            deadline = time.monotonic() + MAX_WAIT[PROGRAM]
+            while True:
+                if not self._programming:
+                    if self._first_ready(PROGRAM) is None or time.monotonic() >= deadline:
+                        break
+                self._cond.wait(0.05)
+            self._erase_busy = True
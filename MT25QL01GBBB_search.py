@@ -0,0 +1,148 @@
+# MT25QL01GBBB_search.py
+# フラッシュの範囲からバイト列(シグネチャ)を探す
+# ヘッダ領域が壊れたときに、JPEGの先頭(FF D8 FF)・末尾(FF D9)やレコードのマジックから写真を拾い直すためのもの
+#
+# 大きなチャンクで順に読み、チャンクごとに bytearray.find で探す(1バイトずつは見ない)
+# 前のチャンクの最後の (最長シグネチャ-1) バイトを次のチャンクの前に残すので、境界をまたぐものも見つかる
+# 残したバイトも含めてすべて 0xFF (消去済み)なら、0xFF だけのシグネチャ以外は探さずに飛ばす
+#
+# 使い方:
+#   python3 MT25QL01GBBB_search.py --start 0x05B60000 --length 0x7E0000
+#   python3 MT25QL01GBBB_search.py -s mark=4D4D4A -o hits.csv
+#   python3 MT25QL01GBBB_search.py --jpeg recovered/      # SOI と次の EOI の組をファイルに書き出す
+
+# -*- coding: utf-8 -*-
+import os
+import sys
+import argparse
+
+from MT25QL01GBBB_logstore import RECORD_MAGIC, SUPERBLOCK_MAGIC
+from MT25QL01GBBB_regions import TABLE_MAGIC
+
+
+JPEG_SOI = b'\xff\xd8\xff'
+JPEG_EOI = b'\xff\xd9'
+
+DEFAULT_SIGNATURES = {
+    'jpeg_soi': JPEG_SOI,
+    'jpeg_eoi': JPEG_EOI,
+    'log_record': RECORD_MAGIC,
+    'log_superblock': SUPERBLOCK_MAGIC,
+    'region_table': TABLE_MAGIC,
+}
+SEARCH_CHUNK = 0x40000
+# 1つの写真として取り出す最大の長さ(これより離れた EOI とは組にしない)
+MAX_JPEG_SIZE = 0x800000
+
+
+# start から length バイトで signatures ({名前: バイト列}) を探し、(アドレス, 名前) をアドレス順に返すジェネレータ
+def search(flash, signatures, start=0, length=None, chunk_size=SEARCH_CHUNK):
+    if length is None:
+        length = flash.FLASH_SIZE - start
+    signatures = {name: bytes(sig) for name, sig in signatures.items() if sig}
+    keep = max(len(sig) for sig in signatures.values()) - 1
+    # 0xFF だけのシグネチャは消去済みのチャンクでも探す
+    blank_signatures = {name: sig for name, sig in signatures.items() if sig.count(0xFF) == len(sig)}
+    blank = b'\xff' * (keep + chunk_size)
+    # 先頭 keep バイトに前のチャンクの終わりを残し、その後ろに読み込む
+    buf = bytearray(keep + chunk_size)
+    view = memoryview(buf)
+    tail = 0        # buf の先頭に残っている前のチャンクのバイト数
+    address = start
+    end = start + length
+    while address < end:
+        n = min(chunk_size, end - address)
+        flash.read_into(address, view[keep:keep + n])
+        base = address - tail   # buf[keep - tail] のアドレス
+        window_start = keep - tail
+        window_end = keep + n
+        if view[window_start:window_end] == blank[:window_end - window_start]:
+            targets = blank_signatures
+        else:
+            targets = signatures
+        hits = []
+        for name, sig in targets.items():
+            # 前のチャンクの中で終わるものは前回見つけているので、keep より後ろで終わるものだけ
+            position = buf.find(sig, max(window_start, keep - len(sig) + 1), window_end)
+            while position >= 0:
+                hits.append((base + position - window_start, name))
+                position = buf.find(sig, position + 1, window_end)
+        hits.sort()
+        yield from hits
+        # 次のチャンクのために終わりの keep バイトを前に移す
+        tail = min(keep, tail + n)
+        if keep:
+            buf[keep - tail:keep] = buf[window_end - tail:window_end]
+        address += n
+
+
+# SOI と、それに対応する EOI を組にして (開始アドレス, 長さ) をアドレス順に返す
+# (EXIFのサムネイルは写真の中に SOI/EOI を持つので、開いている SOI を積んでおき、外側の組だけを返す)
+# 閉じないまま max_size を超えた(または最後まで閉じなかった) SOI は書きかけとして捨て、
+# その中で閉じていた組を代わりに返す (書きかけの写真の後ろにある写真を取りこぼさない)
+def jpeg_extents(hits, max_size=MAX_JPEG_SIZE):
+    extents = []
+    stack = []  # 開いている SOI: [アドレス, その中で閉じた組のリスト]
+    for address, name in hits:
+        while stack and address - stack[0][0] > max_size:
+            extents.extend(stack.pop(0)[1])
+        if name == 'jpeg_soi':
+            stack.append([address, []])
+        elif name == 'jpeg_eoi' and stack:
+            soi, _ = stack.pop()
+            extent = (soi, address + len(JPEG_EOI) - soi)
+            if stack:
+                stack[-1][1].append(extent)
+            else:
+                extents.append(extent)
+    while stack:
+        extents.extend(stack.pop(0)[1])
+    extents.sort()
+    return extents
+
+
+# 16進の文字列をシグネチャにする ('FFD8FF' や 'ff d8 ff')
+def parse_signature(text):
+    name, _, value = text.partition('=')
+    return name, bytes.fromhex(value)
+
+
+if __name__ == '__main__':
+    import MT25QL01GBBB_20231023 as MT25QL01GBBB
+
+    parser = argparse.ArgumentParser(description='MT25QL01GBBB signature search')
+    parser.add_argument('--start', type=lambda s: int(s, 0), default=0)
+    parser.add_argument('--length', type=lambda s: int(s, 0), default=None)
+    parser.add_argument('-s', '--signature', action='append', default=[], type=parse_signature,
+                        help='extra signature as name=HEX')
+    parser.add_argument('--only', action='store_true', help='search only the -s signatures')
+    parser.add_argument('-o', '--output', default=None, help='write hits as CSV (address,name)')
+    parser.add_argument('--jpeg', default=None, help='directory to write recovered JPEG files')
+    args = parser.parse_args()
+
+    signatures = {} if args.only else dict(DEFAULT_SIGNATURES)
+    signatures.update(args.signature)
+    Flash = MT25QL01GBBB.get_flash()
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    hits = []
+    try:
+        for address, name in search(Flash, signatures, args.start, args.length):
+            hits.append((address, name))
+            out.write("0x{:08X},{}\n".format(address, name))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    counts = {}
+    for _, name in hits:
+        counts[name] = counts.get(name, 0) + 1
+    print(", ".join("{} {}".format(name, count) for name, count in sorted(counts.items())), file=sys.stderr)
+
+    if args.jpeg:
+        os.makedirs(args.jpeg, exist_ok=True)
+        for address, length in jpeg_extents(hits):
+            path = os.path.join(args.jpeg, "0x{:08X}.jpg".format(address))
+            with open(path, 'wb') as f:
+                for chunk in Flash.read_chunks(address, length):
+                    f.write(chunk)
+            print("{} ({} bytes)".format(path, length), file=sys.stderr)
@@ -0,0 +1,104 @@
+# MT25QL01GBBB_writer.py
+# フラッシュへの書き込み・消去を別スレッドで行うライタ
+# 撮影ループなどから (アドレス, データ) を投げておけば、次の撮影と並行して書き込まれる
+#
+# 使い方:
+#   Flash = MT25QL01GBBB.get_flash()
+#   with flash_writer(Flash) as writer:
+#       future = writer.submit(address, jpeg_bytes)
+#       ...                      # 次の撮影
+#       writer.flush()           # ここまでに投げた書き込みがすべて終わるまで待つ
+#
+# キューがいっぱいのとき submit は空くまで待つ(バックプレッシャ)
+# 書き込みは flash.lock の中で行うので、同じ flash を他から使うときも flash.lock (= writer.lock) を取ればよい
+
+# -*- coding: utf-8 -*-
+import queue
+import threading
+from concurrent.futures import Future
+
+
+# 書き込み方法
+#  'update' : update_bytes (読み比べて必要なときだけ消去。周りのデータは残る)
+#  'erase'  : 範囲を含む4KBサブセクタを erase_range で消してから write_bytes (周りのデータも消える)
+#  'program': 消去済みの領域に write_bytes だけ行う
+WRITE_MODES = ('update', 'erase', 'program')
+
+_STOP = object()
+
+
+class flash_writer:
+    def __init__(self, flash, maxsize=8):
+        self.flash = flash
+        self.lock = flash.lock
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name='flash_writer', daemon=True)
+        self._closed = False
+        self._thread.start()
+
+    # 書き込みを予約して Future を返す。Future の結果は各書き込み関数の戻り値
+    # data は書き込みが終わるまで変更しないこと
+    # timeout 秒待ってもキューが空かなければ queue.Full
+    def submit(self, address, data, mode='update', timeout=None):
+        if mode not in WRITE_MODES:
+            raise ValueError('unknown write mode: {}'.format(mode))
+        if self._closed:
+            raise RuntimeError('flash_writer is closed')
+        future = Future()
+        self._queue.put((future, address, data, mode), timeout=timeout)
+        return future
+
+    # それまでに submit した書き込みがすべて終わるまで待つ
+    def flush(self, timeout=None):
+        future = Future()
+        self._queue.put((future, None, None, None), timeout=timeout)
+        future.result(timeout)
+
+    # キューに残っている書き込み数
+    def pending(self):
+        return self._queue.qsize()
+
+    # 残りの書き込みを終えてからスレッドを止める
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            future, address, data, mode = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            if address is None:
+                # flush の区切り
+                future.set_result(None)
+                continue
+            try:
+                with self.lock:
+                    result = self._write(address, data, mode)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _write(self, address, data, mode):
+        if mode == 'update':
+            return self.flash.update_bytes(address, data)
+        if mode == 'erase':
+            unit = self.flash.SUBSECTOR_SIZE_OF_4KB
+            start = address - address % unit
+            end = address + len(memoryview(data).cast('B'))
+            end += -end % unit
+            self.flash.erase_range(start, end - start)
+        return self.flash.write_bytes(address, data)
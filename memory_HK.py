@@ -3,7 +3,7 @@ import MT25QL01GBBB_20231023 as MT25QL01GBBB
 import time
 
 # Flashメモリのクラスをインスタンス化
-Flash = MT25QL01GBBB.flash()
+Flash = MT25QL01GBBB.get_flash()
 
 print("--- 外部フラッシュメモリの現在のステータスを監視します ---")
 print("Ctrl+Cで終了します。")
@@ -24,6 +24,6 @@ except KeyboardInterrupt:
     print("\n監視を終了します。")
 
 finally:
-    # __del__が呼ばれるようにインスタンスを削除
-    del Flash
+    # spidevを閉じる
+    MT25QL01GBBB.close_shared()
     print("--- 監視終了 ---")
\ No newline at end of file
@@ -10,30 +10,23 @@ TEST_STRING = "Hello MMJ"
 # ----------------
 
 # Flashメモリのクラスをインスタンス化
-Flash = MT25QL01GBBB.flash()
+Flash = MT25QL01GBBB.get_flash()
 
 print("--- 外部フラッシュメモリの書き込み・読み出しテストを開始します ---")
 
 try:
-    # 1. 消去 (Erase)
+    # 1. 書き込み (Write)
     # ----------------------------------------------------------------
-    # Flashメモリは、書き込む前に該当領域を消去する必要があります。
-    # ここではTEST_ADDRESSを含む4KBのサブセクタを消去します。
-    print(f"1. アドレス {hex(TEST_ADDRESS)} を含む4KBサブセクタを消去します...")
-    Flash.SUBSECTOR_4KB_ERASE_OF(TEST_ADDRESS)
-    print("   -> 消去コマンドを送信しました。")
-    # 消去処理には時間がかかるため、少し待機します。
-    # (ライブラリ内でビジー状態をチェックしていますが、念のため)
-    time.sleep(0.5) 
-    print("   -> 消去完了。")
+    # Flashメモリは、1→0 以外の変化を書き込む前に該当領域を消去する必要があります。
+    # update_bytes は現在の内容を読み比べ、必要なときだけ4KBサブセクタを消去します。
+    # (同じ内容ならなにもせず、1→0 の変化だけなら消去せずに書き込みます)
+    # テスト文字列をバイト列に変換します。
+    write_data = TEST_STRING.encode('utf-8')
 
-    # 2. 書き込み (Write)
-    # ----------------------------------------------------------------
-    # テスト文字列をバイトのリストに変換します。
-    write_data = list(TEST_STRING.encode('utf-8'))
-    
-    print(f"\n2. アドレス {hex(TEST_ADDRESS)} にデータを書き込みます...")
-    Flash.WRITE_DATA_BYTES_SMF(TEST_ADDRESS, write_data)
+    print(f"1. アドレス {hex(TEST_ADDRESS)} にデータを書き込みます...")
+    stats = Flash.update_bytes(TEST_ADDRESS, write_data)
+    print(f"   -> 消去したサブセクタ: {stats.erased_subsectors}, "
+          f"書き込んだページ: {stats.programmed_pages}, 省いたページ: {stats.skipped_pages}")
     print(f"   -> 書き込んだデータ: '{TEST_STRING}'")
     
     status = Flash.read_status_register()
@@ -42,9 +35,9 @@ try:
     print("   -> 書き込み完了。")
     time.sleep(0.1)
 
-    # 3. 読み出し (Read)
+    # 2. 読み出し (Read)
     # ----------------------------------------------------------------
-    print(f"\n3. アドレス {hex(TEST_ADDRESS)} からデータを読み出します...")
+    print(f"\n2. アドレス {hex(TEST_ADDRESS)} からデータを読み出します...")
     
     print("   -> READ_DATA_BYTES_SMF関数を呼び出します...")
     # 書き込んだデータと同じ長さを読み出します。
@@ -66,10 +59,13 @@ try:
     print(f"   -> 読み出したデータ: '{read_string}'")
     print("   -> 読み出し完了。")
     
-    # 4. 検証 (Verify)
+    # 3. 検証 (Verify)
     # ----------------------------------------------------------------
-    print("\n4. データの検証を行います...")
-    if TEST_STRING == read_string:
+    print("\n3. データの検証を行います...")
+    mismatches = Flash.verify_range(TEST_ADDRESS, write_data)
+    for m in mismatches:
+        print(f"   -> 不一致: {hex(m.address)} (期待crc {m.expected_crc:08x}, 読み出しcrc {m.actual_crc:08x})")
+    if not mismatches and TEST_STRING == read_string:
         print("   ✅ [成功] 書き込んだデータと読み出したデータが完全に一致しました！")
     else:
         print("   ❌ [失敗] データが一致しませんでした。")
@@ -0,0 +1,141 @@
+# test_MT25QL01GBBB_flash.py
+# MT25QL01GBBB_20231023.flash の回帰テスト (エミュレータで動かす)
+#   python3 -m unittest test_MT25QL01GBBB_flash
+
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import MT25QL01GBBB_20231023 as MT25QL01GBBB
+import MT25QL01GBBB_emulator
+
+
+class flash_emulator_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        image = os.path.join(self.dir, 'flash.img')
+        spi = MT25QL01GBBB_emulator.SpiDev(image, size=0x1000000, time_scale=1.0)
+        self.flash = MT25QL01GBBB.flash(spi=spi, arbitrate=False,
+                                        erase_count_path=os.path.join(self.dir, 'erase_counts'))
+
+    def tearDown(self):
+        self.flash.close()
+        shutil.rmtree(self.dir)
+
+    # lock を取らない書き込み・消去を別のスレッドから同時に呼んでも、どちらも欠けない
+    def test_concurrent_program_and_erase(self):
+        flash = self.flash
+        data = os.urandom(0x4000)
+        flash.update_bytes(0x300000, b'\x00' * 16)
+        errors = []
+
+        def run(func):
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+
+        def pages():
+            for offset in range(0, 0x1000, 256):
+                flash.WRITE_DATA_BYTES_SMF(0x200000 + offset, b'\x5a' * 256)
+
+        threads = [threading.Thread(target=run, args=(func,)) for func in (
+            lambda: flash.write_bytes(0x100000, data),
+            pages,
+            lambda: flash.SECTOR_ERASE(0x300000),
+        )]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(flash.read_bytes(0x100000, len(data)), data)
+        self.assertEqual(flash.read_bytes(0x200000, 0x1000), b'\x5a' * 0x1000)
+        self.assertTrue(flash.is_blank(0x300000, flash.SECTOR_SIZE))
+
+    # キャッシュブロックが消去中のサブセクタを含むときは、一時停止して読まずに消去の完了を待つ
+    # (一時停止中に読んだブロックには消去途中の中身が入り、消去後も残ってしまう)
+    def test_urgent_read_with_large_cache_block(self):
+        flash = self.flash
+        flash.enable_cache(block_size=0x10000)
+        flash.update_bytes(0x400000, b'\xa5' * 0x2000)
+        suspended = []
+        suspend = flash.suspend
+        flash.suspend = lambda: suspended.append(suspend()) or suspended[-1]
+        thread = threading.Thread(target=flash.SUBSECTOR_4KB_ERASE_OF, args=(0x401000,))
+        thread.start()
+        while flash._busy_op is None and thread.is_alive():
+            pass
+        self.assertEqual(flash.read_urgent(0x400000, 16), b'\xa5' * 16)
+        thread.join()
+        self.assertNotIn(True, suspended)
+        self.assertEqual(flash.read_bytes(0x401000, 16), b'\xff' * 16)
+
+    # chunk_size がページより小さくても、ページの区切りと crc がずれない
+    def test_verify_range_small_chunk(self):
+        flash = self.flash
+        data = bytearray(os.urandom(0x3000))
+        flash.update_bytes(0x500000, data)
+        crcs = MT25QL01GBBB.page_crcs(data)
+        self.assertEqual(flash.verify_range(0x500000, crcs, len(data), chunk_size=100), [])
+        data[0x1234] ^= 0xff
+        mismatches = flash.verify_range(0x500000, data, chunk_size=100)
+        self.assertEqual([m.address for m in mismatches], [0x501200])
+
+
+# SPI_IOC_RD/WR_MODE32 だけを受け付ける spidev の代わり
+# supported にないビット(2線/4線受信)は、カーネルの spi_setup と同じく黙って落とす
+class fake_mode_ioctl:
+    def __init__(self, supported):
+        self.mode = 0
+        self.supported = supported
+
+    def ioctl(self, fd, request, arg):
+        if request == MT25QL01GBBB.SPI_IOC_RD_MODE32:
+            arg[:] = self.mode.to_bytes(4, 'little')
+        elif request == MT25QL01GBBB.SPI_IOC_WR_MODE32:
+            self.mode = int.from_bytes(arg, 'little') & ~(MT25QL01GBBB.SPI_RX_DUAL | MT25QL01GBBB.SPI_RX_QUAD) \
+                | int.from_bytes(arg, 'little') & self.supported
+
+
+class read_mode_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        spi = MT25QL01GBBB_emulator.SpiDev(os.path.join(self.dir, 'flash.img'), size=0x1000000)
+        self.flash = MT25QL01GBBB.flash(spi=spi, arbitrate=False,
+                                        erase_count_path=os.path.join(self.dir, 'erase_counts'))
+
+    def tearDown(self):
+        self.flash._fd = None
+        self.flash.close()
+        shutil.rmtree(self.dir)
+
+    def set_mode(self, fake, mode):
+        self.flash._fd = 99
+        with mock.patch.object(MT25QL01GBBB, 'fcntl', fake):
+            return self.flash.set_read_mode(mode)
+
+    # 2線/4線に対応していないコントローラでは 'read' に戻る
+    def test_unsupported_rx_nbits(self):
+        fake = fake_mode_ioctl(0)
+        self.assertEqual(self.set_mode(fake, 'dual'), 'read')
+        self.assertEqual(self.set_mode(fake, 'quad'), 'read')
+        self.assertEqual(self.flash._read_nbits, 1)
+
+    # 対応していれば設定され、'read' に戻すとビットを外す
+    def test_supported_rx_nbits(self):
+        fake = fake_mode_ioctl(MT25QL01GBBB.SPI_RX_DUAL)
+        self.assertEqual(self.set_mode(fake, 'dual'), 'dual')
+        self.assertTrue(fake.mode & MT25QL01GBBB.SPI_RX_DUAL)
+        self.assertEqual(self.set_mode(fake, 'quad'), 'read')
+        self.assertEqual(self.set_mode(fake, 'dual'), 'dual')
+        self.assertEqual(self.set_mode(fake, 'read'), 'read')
+        self.assertEqual(fake.mode & (MT25QL01GBBB.SPI_RX_DUAL | MT25QL01GBBB.SPI_RX_QUAD), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
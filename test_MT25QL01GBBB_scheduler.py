@@ -0,0 +1,68 @@
+# test_MT25QL01GBBB_scheduler.py
+# flash_scheduler の回帰テスト (エミュレータで動かす)
+#   python3 -m unittest test_MT25QL01GBBB_scheduler
+
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import MT25QL01GBBB_20231023 as MT25QL01GBBB
+import MT25QL01GBBB_emulator
+from MT25QL01GBBB_scheduler import flash_scheduler
+
+
+class scheduler_order_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        image = os.path.join(self.dir, 'flash.img')
+        spi = MT25QL01GBBB_emulator.SpiDev(image, size=0x1000000, time_scale=0.1)
+        self.flash = MT25QL01GBBB.flash(spi=spi, arbitrate=False,
+                                        erase_count_path=os.path.join(self.dir, 'erase_counts'))
+
+    def tearDown(self):
+        self.flash.close()
+        shutil.rmtree(self.dir)
+
+    # 消去→書き込み→読み込みを続けて投げても、投げた順に実行される
+    def test_erase_program_read_same_range(self):
+        address = 0xB00000
+        self.flash.update_bytes(address, b'old!')
+        with flash_scheduler(self.flash) as sched:
+            erase = sched.erase(address, 0x1000)
+            program = sched.program(address, b'NEW!')
+            read = sched.read(address, 4)
+            self.assertEqual(read.result(10), b'NEW!')
+            program.result(10)
+            erase.result(10)
+        self.assertEqual(self.flash.read_bytes(address, 4), b'NEW!')
+
+    # 重ならない読み込みは消去を待たない
+    def test_read_other_range_during_erase(self):
+        self.flash.update_bytes(0x100000, b'keep')
+        with flash_scheduler(self.flash) as sched:
+            erase = sched.erase(0xB00000, 0x10000)
+            read = sched.read(0x100000, 4)
+            self.assertEqual(read.result(10), b'keep')
+            self.assertFalse(erase.done())
+            erase.result(10)
+
+    # 大きな消去の最中でも、重ならない書き込みは消去の単位の合間に実行される
+    def test_program_between_erase_units(self):
+        with flash_scheduler(self.flash) as sched:
+            erase = sched.erase(0x800000, 0x800000)
+            # 消去が始まってから書き込みを投げる
+            while sched.stats()['erase']['depth']:
+                time.sleep(0.001)
+            program = sched.program(0x100000, b'HK!!')
+            program.result(10)
+            self.assertFalse(erase.done())
+            erase.result(60)
+        self.assertEqual(self.flash.read_bytes(0x100000, 4), b'HK!!')
+        self.assertTrue(self.flash.is_blank(0x800000, 0x800000))
+
+
+if __name__ == '__main__':
+    unittest.main()
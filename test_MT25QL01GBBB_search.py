@@ -0,0 +1,31 @@
+# test_MT25QL01GBBB_search.py
+# MT25QL01GBBB_search の回帰テスト (フラッシュは使わない)
+#   python3 -m unittest test_MT25QL01GBBB_search
+
+# -*- coding: utf-8 -*-
+import unittest
+
+from MT25QL01GBBB_search import jpeg_extents
+
+
+class jpeg_extents_test(unittest.TestCase):
+    # サムネイル(内側の組)は返さず、外側の組だけ
+    def test_thumbnail(self):
+        hits = [(0, 'jpeg_soi'), (0x100, 'jpeg_soi'), (0x200, 'jpeg_eoi'), (0x1000, 'jpeg_eoi')]
+        self.assertEqual(jpeg_extents(hits), [(0, 0x1002)])
+
+    # 書きかけ(EOIなし)の写真の後ろにある写真も返す
+    def test_truncated_before_complete(self):
+        hits = [(0, 'jpeg_soi'), (0x100000, 'jpeg_soi'), (0x180000, 'jpeg_eoi'),
+                (0x200000, 'jpeg_soi'), (0x280000, 'jpeg_eoi')]
+        self.assertEqual(jpeg_extents(hits), [(0x100000, 0x80002), (0x200000, 0x80002)])
+
+    # max_size を超えても閉じない SOI を捨てたあとも、続きの組を拾う
+    def test_truncated_expires(self):
+        hits = [(0, 'jpeg_soi'), (0x100, 'jpeg_soi'), (0x200, 'jpeg_eoi'),
+                (0x2000, 'jpeg_soi'), (0x2100, 'jpeg_soi'), (0x2200, 'jpeg_eoi'), (0x3000, 'jpeg_eoi')]
+        self.assertEqual(jpeg_extents(hits, max_size=0x1000), [(0x100, 0x102), (0x2000, 0x1002)])
+
+
+if __name__ == '__main__':
+    unittest.main()